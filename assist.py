@@ -3,11 +3,13 @@ import json
 from gpt import GPT
 from rag import RAG
 from heads import Heads
+from history import History
 
 class Assist:
     def __init__(self, euclid):
         self.euclid = euclid
         self.gpt = GPT()
+        self.history = History()
         self.system = """
         You are part of an AI Agent that is being used to assist lawyers and legal practitioners in doing their work. Your role
         is to decide on what tool to use to assist the user based on the user's prompt and the history of the chat. The possible
@@ -21,11 +23,9 @@ class Assist:
     # a tool for generating a chat name
     def selector(self, prompt, history):
         messages = [{"role": "system", "content": self.system}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, 1000))
         messages.append({"role": "user", "content": prompt})
-        answ = self.gpt.json_gpt(messages, 20)
+        answ = self.gpt.json_gpt(messages, 20, cached=True)
         answer=json.loads(answ)
 
         return answer['tool']
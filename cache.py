@@ -0,0 +1,259 @@
+"""
+    Caches used to avoid repeating work against the OpenAI API.
+    1. EmbeddingCache: a disk backed store of embeddings keyed by model and a hash of the embedded text. The store is bounded
+       in size and evicts the least recently used vectors when it grows past its limit.
+    2. ResponseCache: an LRU cache with a time to live for completions whose output only depends on their request. It has an
+       in-memory tier and an optional on-disk tier shared by all the processes of the app.
+    3. AnswerCache: answers of research questions stored in a separate Chroma collection by the embedding of the question, so
+       that a question close enough to one answered before (above a similarity threshold) gets the stored answer. Answers are
+       scoped by the tables that were searched and by the version of the corpus, bump is called whenever documents are
+       processed, changed or deleted and makes every stored answer stale.
+
+"""
+
+import sqlite3
+import hashlib
+import threading
+import time
+import json
+import chromadb
+from array import array
+from collections import OrderedDict
+from file_control import File_Control
+
+class EmbeddingCache:
+    #counters are shared by every instance in the process
+    lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    def __init__(self, path='../cache/embeddings.db', max_rows=200000):
+        self.db_path = path
+        self.max_rows = max_rows
+        File_Control.create_path('../cache/')
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS embeddings
+                              (key TEXT PRIMARY KEY, model TEXT, vector BLOB, used REAL)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)''')
+            conn.commit()
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256((model + '\0' + text).encode('utf-8')).hexdigest()
+
+    # look up the vectors of many texts, None is returned for every text that is not cached
+    def get_many(self, model, texts):
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                for i in range(0, len(keys), 500):
+                    batch = keys[i:i+500]
+                    cursor.execute("SELECT key, vector FROM embeddings WHERE key IN (" + ','.join('?' * len(batch)) + ")", batch)
+                    for key, blob in cursor.fetchall():
+                        vector = array('f')
+                        vector.frombytes(blob)
+                        found[key] = vector.tolist()
+                if found:
+                    now = time.time()
+                    cursor.executemany("UPDATE embeddings SET used=? WHERE key=?", [(now, key) for key in found])
+                    conn.commit()
+        except Exception as e:
+            print("Embedding cache error: " + str(e))
+        vectors = [found.get(key) for key in keys]
+        with EmbeddingCache.lock:
+            EmbeddingCache.hits += len(texts) - vectors.count(None)
+            EmbeddingCache.misses += vectors.count(None)
+        return vectors
+
+    # store the vectors of many texts and evict the oldest entries if the store is full
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = [(self.key(model, text), model, array('f', vector).tobytes(), now) for text, vector in zip(texts, vectors)]
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.executemany("INSERT OR REPLACE INTO embeddings (key, model, vector, used) VALUES (?, ?, ?, ?)", rows)
+                cursor.execute("SELECT COUNT(*) FROM embeddings")
+                count = cursor.fetchone()[0]
+                if count > self.max_rows:
+                    #evict down to 90% so that eviction does not run on every insert
+                    excess = count - int(self.max_rows * 0.9)
+                    cursor.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,))
+                conn.commit()
+        except Exception as e:
+            print("Embedding cache error: " + str(e))
+
+    def stats(self):
+        with EmbeddingCache.lock:
+            hits = EmbeddingCache.hits
+            misses = EmbeddingCache.misses
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / total if total else 0.0}
+
+
+class ResponseCache:
+    def __init__(self, size=1000, ttl=3600, disk=False, path='../cache/responses.db'):
+        self.size = size
+        self.ttl = ttl
+        self.db_path = path if disk else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.db_path:
+            File_Control.create_path('../cache/')
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''CREATE TABLE IF NOT EXISTS responses
+                                  (key TEXT PRIMARY KEY, response TEXT, expires REAL)''')
+                conn.commit()
+
+    # the key of a request is a hash of everything sent to the model
+    @staticmethod
+    def key(request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self.entries[key]
+        if self.db_path:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT response, expires FROM responses WHERE key=?", (key,))
+                    row = cursor.fetchone()
+                    if row and row[1] > now:
+                        self._remember(key, row[0], row[1])
+                        with self.lock:
+                            self.disk_hits += 1
+                        return row[0]
+            except Exception as e:
+                print("Response cache error: " + str(e))
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, response, expires):
+        with self.lock:
+            self.entries[key] = (response, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def put(self, key, response):
+        expires = time.time() + self.ttl
+        self._remember(key, response, expires)
+        if self.db_path:
+            try:
+                with sqlite3.connect(self.db_path) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("INSERT OR REPLACE INTO responses (key, response, expires) VALUES (?, ?, ?)", (key, response, expires))
+                    cursor.execute("DELETE FROM responses WHERE expires<?", (time.time(),))
+                    conn.commit()
+            except Exception as e:
+                print("Response cache error: " + str(e))
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            hits = self.hits + self.disk_hits
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self.entries),
+                    'hit_rate': hits / total if total else 0.0}
+
+
+class AnswerCache:
+    lock = threading.Lock()
+    shared_cache = None
+    version_path = '../cache/corpus.json'
+
+    def __init__(self, path='../cache/answers/', threshold=0.95, ttl=7*24*3600):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.handle = chromadb.PersistentClient(path=path)
+        self.table = self.handle.get_or_create_collection('answers', metadata={"hnsw:space": "cosine"})
+        self.cleaned = None
+        self.hits = 0
+        self.misses = 0
+
+    # one cache for the whole process, settings are read from 'answer_cache' in keys.json
+    @staticmethod
+    def shared(settings=None):
+        with AnswerCache.lock:
+            if AnswerCache.shared_cache is None:
+                settings = settings or {}
+                AnswerCache.shared_cache = AnswerCache(threshold=settings.get('threshold', 0.95), ttl=settings.get('ttl', 7*24*3600))
+            return AnswerCache.shared_cache
+
+    # the version of the corpus, it changes every time a document is processed, changed or deleted
+    @staticmethod
+    def version():
+        try:
+            return File_Control.load_json(AnswerCache.version_path)['version']
+        except Exception:
+            return 0
+
+    @staticmethod
+    def bump():
+        with AnswerCache.lock:
+            version = AnswerCache.version() + 1
+            try:
+                File_Control.create_path('../cache/')
+                File_Control.save_json(AnswerCache.version_path, {'version': version, 'time': time.time()})
+            except Exception as e:
+                print("Answer cache error: " + str(e))
+            return version
+
+    # the tables an answer was searched in and anything else that changes the answer (search settings, chat history)
+    @staticmethod
+    def scope(tables, *settings):
+        names = sorted(str(getattr(table, 'name', table)) for table in tables)
+        return hashlib.sha256(json.dumps([names, settings], default=str).encode('utf-8')).hexdigest()
+
+    # the stored answer closest to the embedding of a question, None when there is none above the threshold
+    def get(self, vector, scope):
+        version = self.version()
+        try:
+            results = self.table.query(query_embeddings=[vector], n_results=1,
+                                       where={'$and': [{'scope': scope}, {'version': version}]})
+            if results['ids'][0]:
+                meta = results['metadatas'][0][0]
+                if 1 - results['distances'][0][0] >= self.threshold and meta['expires'] > time.time():
+                    with self.lock:
+                        self.hits += 1
+                    return {'answer': meta['answer'], 'sources': json.loads(meta['sources']), 'prompt': results['documents'][0][0]}
+        except Exception as e:
+            print("Answer cache error: " + str(e))
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, prompt, vector, scope, answer, sources):
+        version = self.version()
+        key = hashlib.sha256((scope + '\0' + str(version) + '\0' + prompt).encode('utf-8')).hexdigest()
+        meta = {'scope': scope, 'version': version, 'answer': answer, 'sources': json.dumps(sources),
+                'expires': time.time() + self.ttl}
+        try:
+            self.table.upsert(ids=[key], embeddings=[vector], documents=[prompt], metadatas=[meta])
+            if self.cleaned != version:
+                #answers of older versions of the corpus can not be hit again
+                self.table.delete(where={'$or': [{'version': {'$lt': version}}, {'expires': {'$lt': time.time()}}]})
+                self.cleaned = version
+        except Exception as e:
+            print("Answer cache error: " + str(e))
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                    'version': self.version()}
@@ -1,9 +1,13 @@
 import sqlite3
 import random
+import secrets
+import time
 import json
 from datetime import datetime, timedelta
 import hashlib
+from tracing import Tracing
 
+@Tracing.traced_class('database')
 class Database:
     def __init__(self):
         self.db_path = '../datastore.db'
@@ -27,6 +31,12 @@ class Database:
                               (ad_id TEXT, user_id TEXT, chat_id TEXT, viewed_at TEXT)''')
         cursor.execute('''CREATE TABLE IF NOT EXISTS ad_leads
                               (ad_id TEXT, user_id TEXT, name TEXT, email TEXT, phone TEXT, status TEXT, created_at TEXT)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS summaries
+                              (chat_id TEXT PRIMARY KEY, upto INTEGER, summary TEXT)''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS jobs
+                              (job_id TEXT PRIMARY KEY, kind TEXT, params TEXT, status TEXT, progress REAL, message TEXT,
+                               result TEXT, error TEXT, attempts INTEGER, created_at TEXT, updated_at TEXT, user_id TEXT,
+                               worker TEXT, heartbeat REAL)''')
 
         conn.commit()
         
@@ -699,6 +709,7 @@ class Database:
                 cursor.execute("DELETE FROM chats WHERE chat_id=?", (chat_id,))
                 cursor.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
                 cursor.execute("DELETE FROM media WHERE chat_id=?", (chat_id,))
+                cursor.execute("DELETE FROM summaries WHERE chat_id=?", (chat_id,))
                 conn.commit()
                 return {"status":"success"}
         except Exception as e:
@@ -735,6 +746,32 @@ class Database:
             print("error: "+str(e))
             return []
 
+    #rolling summary of the older messages of a chat
+    def chat_summary(self, chat_id):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT upto, summary FROM summaries WHERE chat_id=?", (chat_id,))
+                row = cursor.fetchone()
+                if row:
+                    return {"upto":row[0],"summary":row[1]}
+                return None
+        except Exception as e:
+            print("error: "+str(e))
+            return None
+
+    #save the rolling summary of a chat, upto is the number of messages it covers
+    def save_summary(self, chat_id, upto, summary):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("INSERT OR REPLACE INTO summaries (chat_id, upto, summary) VALUES (?, ?, ?)",
+                               (chat_id, upto, summary))
+                conn.commit()
+            return {"status": "success"}
+        except Exception as e:
+            return {"status": "Error: " + str(e)}
+
     #add new media file
     def add_file(self, chat_id,user_id,file,content):
         try:
@@ -977,3 +1014,98 @@ class Database:
                 return {'status':'success'}
         except Exception as e:
             return {"status": "Error: " + str(e)}
+
+    #add a background job of a user, params is a dict given to the job function
+    def add_job(self, kind, params, user_id=None):
+        try:
+            #job ids give access to the results of the job, they must not be guessable
+            job_id = "job" + secrets.token_hex(16)
+            now = str(datetime.now())
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("INSERT INTO jobs (job_id, kind, params, status, progress, message, result, error, attempts, created_at, updated_at, user_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (job_id, kind, json.dumps(params), 'queued', 0.0, '', None, None, 0, now, now, user_id))
+                conn.commit()
+            return {"status": "success", "job_id": job_id}
+        except Exception as e:
+            return {"status": "Error: " + str(e)}
+
+    #open a job
+    def job(self, job_id):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM jobs WHERE job_id=?", (job_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                #job_id, kind, params, status, progress, message, result, error, attempts, created_at, updated_at, user_id, worker, heartbeat
+                return {"job_id":row[0],"kind":row[1],"params":json.loads(row[2]),"status":row[3],"progress":row[4],
+                        "message":row[5],"result":json.loads(row[6]) if row[6] else None,"error":row[7],"attempts":row[8],
+                        "created_at":row[9],"updated_at":row[10],"user_id":row[11],"worker":row[12],"heartbeat":row[13]}
+        except Exception as e:
+            print("error: "+str(e))
+            return None
+
+    #update the status, progress, message, result or error of a job
+    def update_job(self, job_id, **fields):
+        try:
+            if 'result' in fields and fields['result'] is not None:
+                fields['result'] = json.dumps(fields['result'])
+            fields['updated_at'] = str(datetime.now())
+            columns = ', '.join(key + '=?' for key in fields)
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE jobs SET " + columns + " WHERE job_id=?", list(fields.values()) + [job_id])
+                conn.commit()
+            return {"status": "success"}
+        except Exception as e:
+            return {"status": "Error: " + str(e)}
+
+    #mark a queued job as running in a worker, False when another worker took it first
+    def claim_job(self, job_id, worker=None):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE jobs SET status='running', attempts=attempts+1, updated_at=?, worker=?, heartbeat=? WHERE job_id=? AND status='queued'",
+                               (str(datetime.now()), worker, time.time(), job_id))
+                conn.commit()
+                return cursor.rowcount == 1
+        except Exception as e:
+            print("error: "+str(e))
+            return False
+
+    #record that a worker is still running its jobs
+    def beat_jobs(self, worker):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE jobs SET heartbeat=? WHERE worker=? AND status='running'", (time.time(), worker))
+                conn.commit()
+            return {"status": "success"}
+        except Exception as e:
+            return {"status": "Error: " + str(e)}
+
+    #queue a running job again when its worker has not been heard from since before, False when it is still alive
+    def requeue_job(self, job_id, before):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("UPDATE jobs SET status='queued', message='restarted', updated_at=? WHERE job_id=? AND status='running' AND (heartbeat IS NULL OR heartbeat<?)",
+                               (str(datetime.now()), job_id, before))
+                conn.commit()
+                return cursor.rowcount == 1
+        except Exception as e:
+            print("error: "+str(e))
+            return False
+
+    #jobs that have not finished, oldest first
+    def unfinished_jobs(self):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT job_id, status, worker, heartbeat FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+                return [{"job_id":row[0],"status":row[1],"worker":row[2],"heartbeat":row[3]} for row in cursor.fetchall()]
+        except Exception as e:
+            print("error: "+str(e))
+            return []
@@ -0,0 +1,172 @@
+"""
+    Class Documents for reading the pages and paragraphs of uploaded documents without parsing the original file on every
+    request.
+    1. open: returns what Collector extracts from a file in ../temp/ (pdf_raw for .pdf, docx_styles for .docx and html_styles
+       for .htm/.html). The first read writes the extraction to ../extracted/ as a compressed pickle keyed by the file id and
+       the modification time of the file, later reads load it from there and the most recently used documents are also kept
+       in memory. The returned list is shared, callers should not modify it.
+    2. forget: removes the stored extraction of a file when the file is deleted.
+    3. section: the text of one section of a processed legislation (from ../data/), for search results that only hold a chunk
+       of the section.
+    4. passages and select: split a document into passages of about the same number of tokens and pick the passages that
+       match a question best (with BM25) plus their neighbours within a token budget, so research reads the relevant parts of
+       a document instead of all of it.
+
+"""
+
+import os
+import gzip
+import pickle
+import threading
+import tiktoken
+from collections import OrderedDict
+from collector import Collector
+from file_control import File_Control
+from lexical import BM25
+
+class Documents:
+    lock = threading.Lock()
+    entries = OrderedDict()
+    size = 16
+    encoding = None
+
+    @staticmethod
+    def extract(file_path, filename):
+        collect = Collector()
+        if filename.lower().endswith('.pdf'):
+            return collect.pdf_raw(file_path)
+        elif filename.lower().endswith('.docx'):
+            return collect.docx_styles(file_path)
+        elif filename.lower().endswith('.htm') or filename.lower().endswith('.html'):
+            return collect.html_styles(file_path)
+        return []
+
+    @staticmethod
+    def folder(table, table_id):
+        return '../extracted/' + table + '-' + table_id + '/'
+
+    @staticmethod
+    def open(table, table_id, file_id, filename):
+        file_path = '../temp/' + table + '-' + table_id + '/' + file_id + '-' + filename
+        try:
+            mtime = os.stat(file_path).st_mtime_ns
+        except OSError:
+            print(f"Error: File '{file_path}' not found.")
+            return []
+        key = (table_id, file_id, mtime)
+        with Documents.lock:
+            if key in Documents.entries:
+                Documents.entries.move_to_end(key)
+                return Documents.entries[key]
+        stored = Documents.folder(table, table_id) + file_id + '-' + str(mtime) + '.pkl.gz'
+        document = None
+        if File_Control.check_path(stored):
+            try:
+                with gzip.open(stored, 'rb') as f:
+                    document = pickle.load(f)
+            except Exception as e:
+                print(f"Error opening extracted document at {stored}: {e}")
+        if document is None:
+            document = Documents.extract(file_path, filename)
+            if document:
+                Documents._store(table, table_id, file_id, stored, document)
+        with Documents.lock:
+            Documents.entries[key] = document
+            while len(Documents.entries) > Documents.size:
+                Documents.entries.popitem(last=False)
+        return document
+
+    @staticmethod
+    def _store(table, table_id, file_id, stored, document):
+        try:
+            Documents.forget(table, table_id, file_id)
+            File_Control.create_path(Documents.folder(table, table_id))
+            with gzip.open(stored, 'wb', compresslevel=5) as f:
+                pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print(f"Error saving extracted document at {stored}: {e}")
+
+    @staticmethod
+    def forget(table, table_id, file_id):
+        folder = Documents.folder(table, table_id)
+        if not File_Control.check_path(folder):
+            folder_files = []
+        else:
+            folder_files = File_Control.list_files_with_extension(folder, '.pkl.gz')
+        for name in folder_files:
+            if name.startswith(file_id + '-'):
+                File_Control.delete_file(folder + name)
+        with Documents.lock:
+            for key in [key for key in Documents.entries if key[0] == table_id and key[1] == file_id]:
+                del Documents.entries[key]
+
+    @staticmethod
+    def section(table, table_id, file_id, filename, section_id):
+        path = '../data/' + table + '-' + table_id + '/' + file_id + '-' + filename + '.pkl'
+        if not File_Control.check_path(path):
+            return None
+        content = File_Control.open(path)
+        sections = (content or {}).get('sections', [])
+        if section_id >= len(sections):
+            return None
+        section = sections[section_id]
+        #processed files have the lines of a section under 'content', edited ones under 'lines'
+        if 'lines' in section:
+            return ' '.join(section['lines'])
+        return ' '.join(line['text'] for line in section.get('content', []))
+
+    # consecutive pages/paragraphs joined into passages of at most size tokens, longer ones are cut
+    @staticmethod
+    def passages(document, size=400):
+        if Documents.encoding is None:
+            Documents.encoding = tiktoken.get_encoding("cl100k_base")
+        passages = []
+        current = []
+        used = 0
+        for entry in document:
+            tokens = Documents.encoding.encode(entry['text'], disallowed_special=())
+            for start in range(0, len(tokens), size):
+                piece = tokens[start:start + size]
+                if current and used + len(piece) > size:
+                    passages.append({'text': '\n'.join(current), 'tokens': used})
+                    current = []
+                    used = 0
+                current.append(entry['text'] if len(tokens) <= size else Documents.encoding.decode(piece))
+                used = used + len(piece)
+        if current:
+            passages.append({'text': '\n'.join(current), 'tokens': used})
+        return passages
+
+    # the text of the passages matching the question best, with their neighbours, in the order of the document
+    @staticmethod
+    def select(document, question, budget=12000, neighbours=1, size=400):
+        passages = Documents.passages(document, size)
+        if sum(passage['tokens'] for passage in passages) <= budget:
+            return '\n'.join(passage['text'] for passage in passages)
+        scores = BM25([BM25.tokenize(passage['text']) for passage in passages]).scores(BM25.tokenize(question))
+        chosen = set()
+        used = 0
+        for i in sorted(range(len(passages)), key=lambda i: -scores[i]):
+            if scores[i] <= 0:
+                break
+            group = [j for j in range(i - neighbours, i + neighbours + 1) if 0 <= j < len(passages) and j not in chosen]
+            cost = sum(passages[j]['tokens'] for j in group)
+            if used + cost > budget:
+                continue
+            chosen.update(group)
+            used = used + cost
+        if not chosen:
+            #nothing matches, read the start of the document
+            for i, passage in enumerate(passages):
+                if used + passage['tokens'] > budget:
+                    break
+                chosen.add(i)
+                used = used + passage['tokens']
+        text = ''
+        previous = None
+        for i in sorted(chosen):
+            if previous is not None:
+                text = text + ('\n' if i == previous + 1 else '\n[...]\n')
+            text = text + passages[i]['text']
+            previous = i
+        return text
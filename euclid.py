@@ -1,25 +1,109 @@
 import chromadb
-import random
+import threading
+import traceback
+import hashlib
+import json
 import os
 
 from gpt import GPT
+from tracing import Tracing
+from parallel import Parallel
+from lexical import LexicalIndex
+from matrix import MatrixTable
+from file_control import File_Control
 
+@Tracing.traced_class('euclid')
 class Euclid:
+  #every instance shares one client, one lexical index and the handles of the tables that were opened
+  client=None
+  lexical_index=None
+  handles={}
+  lock=threading.RLock()
+
   def __init__(self):
     self.name="Euclid 1"
-    self.handle=chromadb.PersistentClient(path="../euclid/")
+    self.handle=Euclid.shared_client()
+    self.lexical=Euclid.lexical_index
     self.size=0
+    #hybrid search fuses the best k*candidates results of each ranking, rrf is the reciprocal rank fusion constant
+    self.candidates=4
+    self.rrf=60
+    #records written to a table per call of add_many
+    self.batch=5000
+
+  @staticmethod
+  def shared_client():
+    if Euclid.client is None:
+      with Euclid.lock:
+        if Euclid.client is None:
+          Euclid.client=chromadb.PersistentClient(path="../euclid/")
+          Euclid.lexical_index=LexicalIndex()
+    return Euclid.client
+
+  #tables that do not use chroma and their settings, e.g. {'courts':{'engine':'matrix','dtype':'float16'}}
+  @staticmethod
+  def engines():
+    if File_Control.check_path('../euclid/engines.json'):
+      return File_Control.load_json('../euclid/engines.json')
+    return {}
+
+  @staticmethod
+  def _save_engines(engines):
+    File_Control.save_json('../euclid/engines.json',engines)
+
+  #the handle of a table, opened once per process: a chroma collection or a MatrixTable depending on its engine
+  def _table(self,name):
+    handle=Euclid.handles.get(name)
+    if handle is None:
+      with Euclid.lock:
+        handle=Euclid.handles.get(name)
+        if handle is None:
+          settings=Euclid.engines().get(name)
+          if settings and settings['engine']=='matrix':
+            handle=MatrixTable(name,dtype=settings.get('dtype','float32'))
+          else:
+            handle=self.handle.get_collection(name)
+          Euclid.handles[name]=handle
+    return handle
+
+  #id of a record from its file, its place in the file and a hash of its content, so writing it again is an update
+  @staticmethod
+  def record_id(file_id,index,content):
+    digest=hashlib.sha256(json.dumps(content,sort_keys=True,default=str).encode('utf-8')).hexdigest()[:16]
+    return str(file_id)+'-'+str(index)+'-'+digest
+
+  #drop the handle of a table that failed, it is opened again from disk by the next call
+  def _forget(self,name):
+    with Euclid.lock:
+      Euclid.handles.pop(name,None)
 
   #list all tables in the database
   def tables(self):
     li=self.handle.list_collections()
+    li=list(li)+list(Euclid.engines())
 
     return li
 
-  #create a new table
-  def create_table(self, name,metric="cosine"):
+  #create a new table, engine is 'chroma' (HNSW index) or 'matrix' (exact search, for tables up to a few hundred thousand
+  #records) and dtype the type of the vectors of a matrix table ('float32' or 'float16')
+  def create_table(self, name,metric="cosine",engine="chroma",dtype="float32"):
     try:
-      table=self.handle.create_collection(name=name,metadata={"hnsw:space": metric})
+      with Euclid.lock:
+        engines=Euclid.engines()
+        if name in engines:
+          raise ValueError("Collection "+name+" already exists")
+        if engine=='matrix':
+          names=[str(getattr(table,'name',table)) for table in self.handle.list_collections()]
+          if name in names:
+            raise ValueError("Collection "+name+" already exists")
+          table=MatrixTable(name,dtype=dtype)
+          engines[name]={'engine':'matrix','dtype':dtype}
+          Euclid._save_engines(engines)
+        else:
+          table=self.handle.create_collection(name=name,metadata={"hnsw:space": metric})
+        Euclid.handles[name]=table
+      #every record of a new table is indexed as it is added
+      self.lexical.mark(name)
 
       return "success"
     except Exception as e:
@@ -30,7 +114,16 @@ class Euclid:
   #delete a table
   def delete_table(self,name):
     try:
-      self.handle.delete_collection(name=name)
+      with Euclid.lock:
+        Euclid.handles.pop(name,None)
+        engines=Euclid.engines()
+        if name in engines:
+          File_Control.delete_path('../euclid/matrix/'+name+'/')
+          del engines[name]
+          Euclid._save_engines(engines)
+        else:
+          self.handle.delete_collection(name=name)
+      self.lexical.drop(name)
       return "success"
     except Exception as e:
       print(str(e))
@@ -39,11 +132,107 @@ class Euclid:
   #add document into table
   def add(self,table,document,meta,embedds):
     try:
-      id_=str(random.randint(1000000000,99999999999))
-      table=self.handle.get_collection(table)
-      table.add(embeddings=[embedds],documents=[document],metadatas=[meta],ids=[id_])
+      id_=self.record_id(meta.get('file_id',''),0,{'document':document,'meta':meta})
+      collection=self._table(table)
+      collection.upsert(embeddings=[embedds],documents=[document],metadatas=[meta],ids=[id_])
+      self.lexical.add(table,[id_],[self._text(document,meta)])
+    except Exception as e:
+      self._forget(table)
+      print(str(e))
+
+  #add (or update) many documents of a table in batches, ids are derived from the content when not given
+  def add_many(self,table,documents,metas,embeddings,ids=None,batch=None):
+    if ids is None:
+      #records are numbered within their file
+      ids=[]
+      places={}
+      for d, m in zip(documents,metas):
+        place=places.get(m.get('file_id',''),0)
+        places[m.get('file_id','')]=place+1
+        ids.append(self.record_id(m.get('file_id',''),place,{'document':d,'meta':m}))
+    batch=batch or self.batch
+    try:
+      collection=self._table(table)
+      #chroma refuses batches larger than its own limit
+      if hasattr(self.handle,'get_max_batch_size'):
+        batch=min(batch,self.handle.get_max_batch_size())
+      for i in range(0,len(ids),batch):
+        with Tracing.span('euclid.add_batch',records=len(ids[i:i+batch])):
+          collection.upsert(embeddings=embeddings[i:i+batch],documents=documents[i:i+batch],metadatas=metas[i:i+batch],ids=ids[i:i+batch])
+        self.lexical.add(table,ids[i:i+batch],[self._text(d,m) for d, m in zip(documents[i:i+batch],metas[i:i+batch])])
+      return {'result':'success','ids':ids}
+    except Exception as e:
+      self._forget(table)
+      print(str(e))
+      return {'result':'error adding to table: '+str(e)}
+
+  #move a table to another engine ('chroma' or 'matrix'), the records are copied and the old storage is removed
+  def set_engine(self,name,engine,dtype="float32"):
+    try:
+      with Euclid.lock:
+        engines=Euclid.engines()
+        current='matrix' if name in engines else 'chroma'
+        if engine==current and (engine!='matrix' or engines[name].get('dtype')==dtype):
+          return "success"
+        source=self._table(name)
+        records=source.get(include=['documents','metadatas','embeddings'])
+        if engine=='matrix':
+          target=MatrixTable(name+'.new',dtype=dtype)
+        else:
+          target=self.handle.create_collection(name=name,metadata={"hnsw:space": "cosine"})
+        for i in range(0,len(records['ids']),self.batch):
+          target.upsert(ids=records['ids'][i:i+self.batch],embeddings=[list(e) for e in records['embeddings'][i:i+self.batch]],
+                        documents=records['documents'][i:i+self.batch],metadatas=records['metadatas'][i:i+self.batch])
+        Euclid.handles.pop(name,None)
+        if current=='matrix':
+          File_Control.delete_path('../euclid/matrix/'+name+'/')
+        else:
+          self.handle.delete_collection(name=name)
+        if engine=='matrix':
+          os.replace('../euclid/matrix/'+name+'.new/','../euclid/matrix/'+name+'/')
+          engines[name]={'engine':'matrix','dtype':dtype}
+        else:
+          del engines[name]
+        Euclid._save_engines(engines)
+      return "success"
     except Exception as e:
       print(str(e))
+      return "failed: "+str(e)
+
+  #the text indexed for lexical search: the document and the text values of its metadata
+  def _text(self,document,meta):
+    return ' '.join([document or '']+[str(v) for v in meta.values() if isinstance(v,str)])
+
+  #index the records already in a table, for tables created before the lexical index
+  #the table is marked ready only when every record is in, a backfill that stopped is started again by the next search
+  def reindex(self,name):
+    try:
+      table=self._table(name)
+      #ids indexed before the table is read, records added while the backfill runs are not among them and are kept
+      indexed=self.lexical.ids(name)
+      records=table.get(include=['documents','metadatas'])
+      for i in range(0,len(records['ids']),5000):
+        self.lexical.add(name,records['ids'][i:i+5000],[self._text(d,m or {}) for d, m in zip(records['documents'][i:i+5000],records['metadatas'][i:i+5000])])
+        self.lexical.mark(name,'building')
+      stale=indexed-set(records['ids'])
+      if stale:
+        self.lexical.delete(name,list(stale))
+      self.lexical.mark(name)
+    except Exception as e:
+      traceback.print_exc()
+      self.lexical.mark(name,'failed')
+
+  #True when the lexical index of a table is complete, otherwise its backfill is started in the background (once
+  #across processes) so that searches never wait for it
+  def _indexed(self,name,table):
+    if self.lexical.ready(name):
+      return True
+    if table.count()==0:
+      self.lexical.mark(name)
+      return True
+    if self.lexical.claim(name):
+      threading.Thread(target=self.reindex,args=(name,),daemon=True,name='reindex-'+name).start()
+    return False
   
   #add document into table
   def add_multiple(self,table,data,target):
@@ -52,7 +241,7 @@ class Euclid:
     id_=0
     for row in data:
       values.append(row[target])
-      ids.append(str(id_))
+      ids.append(self.record_id(row.get('file_id',table),id_,{k: v for k, v in row.items() if k != target}))
       id_=id_+1
       #end for
     #end for
@@ -65,46 +254,207 @@ class Euclid:
     try:
       size=len(new_ids)
       n=0
-      table=self.handle.get_collection(table)
+      collection=self._table(table)
       while n<size:
-        table.add(embeddings=new_values[n],metadatas=new_metadata[n],ids=new_ids[n])
+        collection.upsert(embeddings=new_values[n],metadatas=new_metadata[n],ids=new_ids[n])
+        self.lexical.add(table,new_ids[n],[self._text('',meta) for meta in new_metadata[n]])
         n=n+1
 
       return {'result':'success'}
     except Exception as e:
+      self._forget(table)
       print(str(e))
       return {'result':'table does not exist: '+str(e)}
 
-  #search for top results
-  def search(self,name,q,k=1):
+  #a metadata filter for search: a file id (or list of them), table id, citation, court and a range of dates as yyyymmdd
+  @staticmethod
+  def where(file_id=None,table_id=None,citation=None,court=None,date_from=None,date_to=None):
+    conditions=[]
+    for key, value in (('file_id',file_id),('table_id',table_id),('citation',citation),('court',court)):
+      if isinstance(value,(list,tuple)):
+        conditions.append({key:{'$in':list(value)}})
+      elif value is not None:
+        conditions.append({key:value})
+    if date_from is not None:
+      conditions.append({'date':{'$gte':int(date_from)}})
+    if date_to is not None:
+      conditions.append({'date':{'$lte':int(date_to)}})
+    if not conditions:
+      return None
+    return conditions[0] if len(conditions)==1 else {'$and':conditions}
+
+  #search for top results, mode is 'vector' (cosine), 'lexical' (BM25) or 'hybrid' (both rankings fused)
+  #where is a chroma metadata filter (see where) applied inside the query
+  def search(self,name,q,k=1,mode='vector',where=None):
     try:
-      table=self.handle.get_collection(name)
+      table=self._table(name)
+      if mode=='lexical':
+        return self._lexical(name,table,q,k,where)
       gpt=GPT()
       embeds=gpt.embedd_text(q)
-      results=table.query(query_embeddings=[embeds],n_results=k)
-      distances=results['distances'][0]
-      metadata=results['metadatas'][0]
-      documents=results['documents'][0]
-      ret_content=[]
-      n=0
-      for data in metadata:
-        data['table']=name
-        data['distance']=1-distances[n]
-        data['document']=documents[n]
-        n=n+1
-        ret_content.append(data)
-
-      return ret_content
+      with Tracing.span('euclid.query'):
+        results=table.query(query_embeddings=[embeds],n_results=k if mode=='vector' else k*self.candidates,where=where)
+      if mode=='hybrid':
+        return self._hybrid(name,table,q,embeds,self._results(name,results,0),k,where)
+      return self._results(name,results,0)
     except Exception as e:
+      self._forget(name)
       print("Error: "+ str(e))
       return {'data':[]}
 
+  #add the table, distance and document to the metadata of the i-th query of a result
+  def _results(self,name,results,i):
+    distances=results['distances'][i]
+    metadata=results['metadatas'][i]
+    documents=results['documents'][i]
+    ids=results['ids'][i]
+    ret_content=[]
+    n=0
+    for data in metadata:
+      data['id']=ids[n]
+      data['table']=name
+      data['distance']=1-distances[n]
+      data['document']=documents[n]
+      n=n+1
+      ret_content.append(data)
+    return ret_content
+
+  #records of a table by id in the format of _results, the distance is computed when the query embedding is given
+  def _records(self,name,table,ids,embeds=None):
+    if not ids:
+      return {}
+    records=table.get(ids=ids,include=['documents','metadatas','embeddings'])
+    found={}
+    for id_, document, data, vector in zip(records['ids'],records['documents'],records['metadatas'],records['embeddings']):
+      data=dict(data or {})
+      data['id']=id_
+      data['table']=name
+      data['document']=document
+      if embeds is not None:
+        dot=sum(a*b for a, b in zip(embeds,vector))
+        norm=(sum(a*a for a in embeds)**0.5)*(sum(b*b for b in vector)**0.5)
+        data['distance']=dot/norm if norm else 0.0
+      found[id_]=data
+    return found
+
+  #keep the lexical hits whose records pass the filter
+  def _allowed(self,table,hits,where):
+    if where is None or not hits:
+      return hits
+    allowed=set(table.get(ids=[id_ for id_, score in hits],where=where,include=[])['ids'])
+    return [(id_, score) for id_, score in hits if id_ in allowed]
+
+  #while the index of the table is being built the hits come from the records indexed so far
+  def _lexical(self,name,table,q,k,where=None):
+    self._indexed(name,table)
+    hits=self.lexical.search(name,q,k if where is None else k*self.candidates)
+    hits=self._allowed(table,hits,where)[:k]
+    found=self._records(name,table,[id_ for id_, score in hits])
+    ret_content=[]
+    for id_, score in hits:
+      if id_ in found:
+        found[id_]['score']=score
+        ret_content.append(found[id_])
+    return ret_content
+
+  #reciprocal rank fusion of the vector results and the BM25 results of the same query
+  #the vector results alone are used until the lexical index of the table is complete
+  def _hybrid(self,name,table,q,embeds,vector_hits,k,where=None):
+    if self._indexed(name,table):
+      lexical_hits=self._allowed(table,self.lexical.search(name,q,k*self.candidates),where)
+    else:
+      lexical_hits=[]
+    scores={}
+    for rank, data in enumerate(vector_hits):
+      scores[data['id']]=scores.get(data['id'],0)+1/(self.rrf+rank+1)
+    for rank, (id_, score) in enumerate(lexical_hits):
+      scores[id_]=scores.get(id_,0)+1/(self.rrf+rank+1)
+    best=sorted(scores,key=lambda id_: -scores[id_])[:k]
+    found={data['id']: data for data in vector_hits}
+    found.update(self._records(name,table,[id_ for id_ in best if id_ not in found],embeds))
+    ret_content=[]
+    for id_ in best:
+      if id_ in found:
+        found[id_]['score']=scores[id_]
+        ret_content.append(found[id_])
+    return ret_content
+
+  #search for many (table, phrase) pairs: all phrases are embedded in one request and every table is queried once
+  #results come back in the order of the queries and a table that fails or times out returns no results
+  def search_many(self,queries,k=1,workers=8,timeout=30,mode='vector',where=None):
+    if not queries:
+      return []
+    embeds=None
+    if mode!='lexical':
+      try:
+        gpt=GPT()
+        #the same phrase asked of several tables is embedded once
+        texts=list(dict.fromkeys(q for name, q in queries))
+        vectors=dict(zip(texts,gpt.embedd_texts(texts)))
+        embeds=[vectors[q] for name, q in queries]
+      except Exception as e:
+        print("Error: "+ str(e))
+        return [[] for query in queries]
+    groups={}
+    for i, (name, q) in enumerate(queries):
+      groups.setdefault(name,[]).append(i)
+    def run(name):
+      table=self._table(name)
+      if mode=='lexical':
+        return [self._lexical(name,table,queries[i][1],k,where) for i in groups[name]]
+      with Tracing.span('euclid.query',queries=len(groups[name])):
+        results=table.query(query_embeddings=[embeds[i] for i in groups[name]],n_results=k if mode=='vector' else k*self.candidates,where=where)
+      found=[self._results(name,results,n) for n in range(len(groups[name]))]
+      if mode=='hybrid':
+        found=[self._hybrid(name,table,queries[i][1],embeds[i],found[n],k,where) for n, i in enumerate(groups[name])]
+      return found
+    names=list(groups)
+    ret_content=[[] for query in queries]
+    for name, found in zip(names,Parallel.map(run,names,workers,timeout)):
+      if found is None:
+        continue
+      for n, i in enumerate(groups[name]):
+        ret_content[i]=found[n]
+    return ret_content
+
+  #search for many phrases at once, phrases are dicts with the phrase and the table to search
+  def search_phrases(self,phrases,k=1,workers=8,timeout=30,mode='vector',where=None):
+    return self.search_many([(phrase['table'],phrase['phrase']) for phrase in phrases],k,workers,timeout,mode,where)
+
+  #search one query in several tables at once and keep the global top k, ranked by similarity (by BM25 score in lexical mode)
+  def search_tables(self,names,q,k=1,mode='vector',where=None,workers=8,timeout=30):
+    results=[]
+    for found in self.search_many([(name,q) for name in names],k,workers,timeout,mode,where):
+      results.extend(found)
+    rank='score' if mode=='lexical' else 'distance'
+    return sorted(results,key=lambda data: -(data.get(rank) or 0))[:k]
+
+  #ids of the records of a table with a metadata value
+  def ids(self,table,key,value):
+    return self._table(table).get(where={key:value},include=[])['ids']
+
+  #delete records of a table by id
+  def delete_ids(self,table,ids):
+    try:
+      collection=self._table(table)
+      for i in range(0,len(ids),self.batch):
+        collection.delete(ids=ids[i:i+self.batch])
+      self.lexical.delete(table,ids)
+      return 'success'
+    except Exception as e:
+      self._forget(table)
+      print(str(e))
+      return 'error'
+
   #delete document into table
   def delete(self,table,key, value):
     try:
-      table=self.handle.get_collection(table)
-      table.delete(where={key:value})
+      collection=self._table(table)
+      ids=collection.get(where={key:value},include=[])['ids']
+      collection.delete(where={key:value})
+      self.lexical.delete(table,ids)
       return 'success'
     except Exception as e:
+      self._forget(table)
       print(str(e))
       return 'error'
\ No newline at end of file
@@ -1,45 +1,241 @@
 """
    Class for interacting with the OpenAI API endpoints.
    1. embedd_text: for embedding text and creat a vector
-   2. json_gpt: using the gpt-4o model provided by OpenAI and generate a JSON formatted response
+   2. embedd_texts: for embedding a list of texts in as few requests as possible, vectors are returned in input order.
+      When a cache is given only the texts missing from the cache are sent to the API
+   3. json_gpt: using the gpt-4o model provided by OpenAI and generate a JSON formatted response
+      With cached=True the response is served from the shared ResponseCache when the same request was made recently,
+      settings for the cache are read from 'response_cache' in keys.json
+   4. json_gpt_stream and gpt_4o_stream: the same completions streamed, yielding the text as it is generated
+
+   All instances share one OpenAI client which is created on first use. The key is read once and the client keeps a pool
+   of keep-alive connections, so creating a GPT object per request is cheap and the client is safe to use from many threads.
+   Every request goes through the Scheduler of its model which keeps it within the rate limits set under 'limits' in keys.json
+   and retries rate limited and failed requests.
+   Every request is recorded as a gpt.* span with its wall time and token usage.
+   The API can be pointed at another server (such as mock_openai.py) with 'base_url' in keys.json or OPENAI_BASE_URL.
 
 """
 
 import openai
+import httpx
+import tiktoken
+import threading
+import time
 import json
 import os
+from scheduler import Scheduler
+from cache import ResponseCache
+from tracing import Tracing
+
+EMBEDD_MODEL="text-embedding-3-small"
+#limits of a single embeddings request
+EMBEDD_MAX_INPUTS=2048
+EMBEDD_MAX_TOKENS=250000
+#connection pool of the shared client
+POOL_CONNECTIONS=64
+POOL_KEEPALIVE=32
+#default rate limits per model, overridden by 'limits' in keys.json
+LIMITS={
+  "gpt-4o":{"rpm":500,"tpm":300000},
+  "gpt-3.5-turbo-instruct":{"rpm":3500,"tpm":90000},
+  EMBEDD_MODEL:{"rpm":3000,"tpm":1000000}
+}
 
 class GPT:
+  encoding=None
+  client=None
+  config={}
+  schedulers={}
+  responses=None
+  lock=threading.Lock()
+
   def __init__(self):
-    open_key=self._load_key('../keys.json')
-    self.key=open_key
+    self.client=GPT.shared_client()
+
+  #create the process wide client on first use
+  @staticmethod
+  def shared_client():
+    if GPT.client is None:
+      with GPT.lock:
+        if GPT.client is None:
+          GPT.config=GPT._load_config('../keys.json')
+          limits=httpx.Limits(max_connections=POOL_CONNECTIONS,max_keepalive_connections=POOL_KEEPALIVE,keepalive_expiry=120)
+          http=httpx.Client(limits=limits,timeout=httpx.Timeout(600,connect=10))
+          base_url=GPT.config.get("base_url") or os.getenv("OPENAI_BASE_URL")
+          key=GPT.config.get("key")
+          if key is None and base_url:
+            key="mock"
+          #retries are done by the scheduler
+          GPT.client=openai.OpenAI(api_key=key,base_url=base_url,http_client=http,max_retries=0)
+    return GPT.client
+
+  #the scheduler holding the rate limits of a model
+  @staticmethod
+  def scheduler(model):
+    with GPT.lock:
+      if model not in GPT.schedulers:
+        limits=dict(LIMITS.get(model,LIMITS["gpt-4o"]))
+        limits.update(GPT.config.get("limits",{}).get(model,{}))
+        GPT.schedulers[model]=Scheduler(limits["rpm"],limits["tpm"])
+      return GPT.schedulers[model]
 
-  #load keys from file
-  def _load_key(self, key_file):
+  #the cache for responses of deterministic calls
+  @staticmethod
+  def response_cache():
+    with GPT.lock:
+      if GPT.responses is None:
+        settings=GPT.config.get("response_cache",{})
+        GPT.responses=ResponseCache(settings.get("size",1000),settings.get("ttl",3600),settings.get("disk",False))
+      return GPT.responses
+
+  #load keys and settings from file
+  @staticmethod
+  def _load_config(key_file):
     try:
       with open(key_file, "r") as f:
-        data = json.load(f)
-        return data.get("key")
+        return json.load(f)
     except Exception as e:
       print(f"An unexpected error occurred: {e}")
-      return None
+      return {}
+
+  #count tokens the way the embedding model does
+  def count_tokens(self,text):
+    if GPT.encoding is None:
+      GPT.encoding=tiktoken.get_encoding("cl100k_base")
+    return len(GPT.encoding.encode(text, disallowed_special=()))
+
+  #the first n tokens of a text
+  def truncate_tokens(self,text,n):
+    if GPT.encoding is None:
+      GPT.encoding=tiktoken.get_encoding("cl100k_base")
+    tokens=GPT.encoding.encode(text, disallowed_special=())
+    if len(tokens)<=n:
+      return text
+    return GPT.encoding.decode(tokens[:max(n,0)])
+
+  #estimate the prompt tokens of a list of chat messages
+  def count_messages(self,messages):
+    n=0
+    for message in messages:
+      content=message['content']
+      if isinstance(content,list):
+        content=' '.join(part.get('text','') for part in content)
+      n=n+self.count_tokens(str(content))+4
+    return n
+
+  #run a chat completion within the rate limits of its model
+  def _chat(self,**kwargs):
+    estimate=self.count_messages(kwargs['messages'])+kwargs.get('max_tokens',0)
+    scheduler=GPT.scheduler(kwargs['model'])
+    with Tracing.span('gpt.chat',model=kwargs['model']) as span:
+      res=scheduler.call(lambda: self.client.chat.completions.create(**kwargs),estimate)
+      if res.usage is not None:
+        scheduler.settle(estimate,res.usage.total_tokens)
+        span['prompt_tokens']=res.usage.prompt_tokens
+        span['completion_tokens']=res.usage.completion_tokens
+    return res
+
+  #stream a chat completion within the rate limits of its model, yielding the text as it arrives
+  def _chat_stream(self,**kwargs):
+    estimate=self.count_messages(kwargs['messages'])+kwargs.get('max_tokens',0)
+    scheduler=GPT.scheduler(kwargs['model'])
+    started=time.perf_counter()
+    with Tracing.span('gpt.chat_stream',model=kwargs['model']) as span:
+      stream=scheduler.call(lambda: self.client.chat.completions.create(stream=True,stream_options={"include_usage":True},**kwargs),estimate)
+      usage=None
+      for chunk in stream:
+        if chunk.usage is not None:
+          usage=chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+          if 'first_token_ms' not in span:
+            span['first_token_ms']=round((time.perf_counter()-started)*1000,2)
+          yield chunk.choices[0].delta.content
+      if usage is not None:
+        scheduler.settle(estimate,usage.total_tokens)
+        span['prompt_tokens']=usage.prompt_tokens
+        span['completion_tokens']=usage.completion_tokens
+
+  #run an embeddings request within the rate limits of the embedding model
+  def _embedd(self,text):
+    texts=text if isinstance(text,list) else [text]
+    estimate=sum(self.count_tokens(t) for t in texts)
+    scheduler=GPT.scheduler(EMBEDD_MODEL)
+    with Tracing.span('gpt.embeddings',inputs=len(texts)) as span:
+      res=scheduler.call(lambda: self.client.embeddings.create( model=EMBEDD_MODEL, input=text),estimate)
+      if res.usage is not None:
+        scheduler.settle(estimate,res.usage.total_tokens)
+        span['prompt_tokens']=res.usage.prompt_tokens
+    return res
+
+  #split texts into batches that fit in one embeddings request
+  def _embedd_batches(self,texts,max_inputs,max_tokens):
+    batch=[]
+    size=0
+    for text in texts:
+      n=self.count_tokens(text)
+      if batch and (len(batch)>=max_inputs or size+n>max_tokens):
+        yield batch
+        batch=[]
+        size=0
+      batch.append(text)
+      size=size+n
+    if batch:
+      yield batch
 
   #embedding
   def embedd_text(self,text):
-    openai.api_key=self.key
-    res=openai.embeddings.create( model="text-embedding-3-small", input=text)
+    res=self._embedd(text)
     return res.data[0].embedding
-  def json_gpt(self,message,tokens=4096):
-    openai.api_key=self.key
-    res = openai.chat.completions.create(model="gpt-4o",messages=message,temperature=0.4,response_format={"type": "json_object"},max_tokens=tokens)
-    return res.choices[0].message.content
+
+  #embedding many texts, returns the vectors in the same order as the texts
+  def embedd_texts(self,texts,cache=None,max_inputs=EMBEDD_MAX_INPUTS,max_tokens=EMBEDD_MAX_TOKENS):
+    if cache is not None:
+      vectors=cache.get_many(EMBEDD_MODEL,texts)
+      missing=list(dict.fromkeys(t for t, v in zip(texts,vectors) if v is None))
+      if missing:
+        fresh=self.embedd_texts(missing,None,max_inputs,max_tokens)
+        cache.put_many(EMBEDD_MODEL,missing,fresh)
+        found=dict(zip(missing,fresh))
+        vectors=[v if v is not None else found[t] for t, v in zip(texts,vectors)]
+      return vectors
+    vectors=[]
+    for batch in self._embedd_batches(texts,max_inputs,max_tokens):
+      res=self._embedd(batch)
+      data=sorted(res.data, key=lambda d: d.index)
+      vectors.extend([d.embedding for d in data])
+    return vectors
+
+  def json_gpt(self,message,tokens=4096,cached=False):
+    request={"model":"gpt-4o","messages":message,"temperature":0.4,"response_format":{"type": "json_object"},"max_tokens":tokens}
+    if cached:
+      cache=GPT.response_cache()
+      key=cache.key(request)
+      content=cache.get(key)
+      if content is not None:
+        return content
+    res = self._chat(**request)
+    content=res.choices[0].message.content
+    if cached:
+      cache.put(key,content)
+    return content
+
+  def json_gpt_stream(self,message,tokens=4096):
+    return self._chat_stream(model="gpt-4o",messages=message,temperature=0.4,response_format={"type": "json_object"},max_tokens=tokens)
 
   def gpt_3(self, text, tokens=500):
-    openai.api_key=self.key
-    res=openai.chat.completions.create(engine="gpt-3.5-turbo-instruct",prompt=text,temperature=0.3,max_tokens=tokens)
+    estimate=self.count_tokens(text)+tokens
+    scheduler=GPT.scheduler("gpt-3.5-turbo-instruct")
+    with Tracing.span('gpt.completion',model="gpt-3.5-turbo-instruct") as span:
+      res=scheduler.call(lambda: self.client.completions.create(model="gpt-3.5-turbo-instruct",prompt=text,temperature=0.3,max_tokens=tokens),estimate)
+      if res.usage is not None:
+        span['prompt_tokens']=res.usage.prompt_tokens
+        span['completion_tokens']=res.usage.completion_tokens
     return res.choices[0].text
 
   def gpt_4o(self, message, tokens=4000):
-    openai.api_key=self.key
-    res = openai.chat.completions.create(model="gpt-4o",messages=message,temperature=0.5,max_tokens=tokens)
+    res = self._chat(model="gpt-4o",messages=message,temperature=0.5,max_tokens=tokens)
     return res.choices[0].message.content
+
+  def gpt_4o_stream(self, message, tokens=4000):
+    return self._chat_stream(model="gpt-4o",messages=message,temperature=0.5,max_tokens=tokens)
@@ -1,8 +1,10 @@
 import os
 import json
 from gpt import GPT
-from collector import Collector
-from langchain.text_splitter import TokenTextSplitter
+from documents import Documents
+from history import History
+from tracing import Tracing
+from research import Research
 import os
 import random
 from docx import Document
@@ -14,7 +16,10 @@ class Heads:
     def __init__(self, euclid):
         self.euclid = euclid
         self.gpt = GPT()
+        self.history = History()
         self.items = []
+        #how Euclid ranks records: 'vector', 'lexical' or 'hybrid' (cosine and BM25 fused)
+        self.search_mode = 'hybrid'
 
         self.drafter = """
         You are part of an AI agent being used for drafting heads of arguments after legal research for a lawyer in Zimbabwe.
@@ -57,6 +62,7 @@ class Heads:
         and citations are very mandatory. Cite as much as possible without hallucinations and also cite precedent/case law used if the
         content is a court ruling and cite sections/subsections/paragraphs ect. if the provided document is alegislation or contract.
         """
+        self.reader = Research(self.gpt, self.researcher, 114000, 12000)
 
         self.data_gather = """
         You are part of an AI-Agent for drafting heads of arguments for lawyers in an AI-powered research tool for lawyers in 
@@ -76,13 +82,12 @@ class Heads:
         are:
         """
 
+    @Tracing.traced('heads.gather')
     def gather(self, prompt, history, tables):
         messages = [{"role": "system", "content": self.data_gather + str(tables)}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, 6000))
         messages.append({"role": "user", "content": prompt})
-        answ = self.gpt.json_gpt(messages, 4060)
+        answ = self.gpt.json_gpt(messages, 4060, cached=True)
         answer = json.loads(answ)
         return answer
 
@@ -97,45 +102,29 @@ class Heads:
         return sources
 
     def open_file(self, file_id, filename, table, table_id):
-        file_path = f'../temp/{table}-{table_id}/{file_id}-{filename}'
-        collect = Collector()
-        if filename.lower().endswith('.pdf'):
-            document = collect.pdf_raw(file_path)
-        elif filename.lower().endswith('.docx'):
-            document = collect.docx_styles(file_path)
-        elif filename.lower().endswith(('.htm', '.html')):
-            document = collect.html_styles(file_path)
-        return document
-
-    def research(self, question, source):
-        document = self.open_file(source['file_id'], source['filename'], source['table'], source['table_id'])
-        text = '\n'.join(t['text'] for t in document)
-        splitter = TokenTextSplitter(chunk_size=114000, chunk_overlap=200)
-        chunks = splitter.split_text(text)
-        answers = ''
-        for chunk in chunks:
-            context = f"Research topic (Question): {question}\n\n\n Document Name(Citation): {source['citation']}\nDocument/ Part of Document: {chunk}"
-            messages = [{"role": "system", "content": self.researcher}]
-            messages.append({"role": "user", "content": context})
-            answers += '\n' + self.gpt.gpt_4o(messages, 12000)
-        return answers
+        return Documents.open(table, table_id, file_id, filename)
 
+    # the research of every source, None when nothing of it could be read
+    @Tracing.traced('heads.research')
+    def research(self, question, sources, query=None):
+        return self.reader.run(question, sources, query)
+
+    @Tracing.traced('heads.drafting')
     def drafting(self, prompt, history, phrases, k):
         raw_sources = []
-        for phrase in phrases:
-            raw_sources.extend(self.euclid.search(phrase['table'], phrase['phrase'], k))
+        for results in self.euclid.search_phrases(phrases, k, mode=self.search_mode):
+            raw_sources.extend(results)
 
         sources = self.load_unique(raw_sources)
+        answers = self.research(str(phrases), sources, ' '.join(phrase['phrase'] for phrase in phrases))
         researches = [
-            {'citation': source['citation'], 'research_answer': self.research(str(phrases), source)}
-            for source in sources
+            {'citation': source['citation'], 'research_answer': answer}
+            for source, answer in zip(sources, answers) if answer is not None
         ]
 
         context = f"Research: {researches}\n Prompt: {prompt}"
         messages = [{"role": "system", "content": self.drafter}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, 6000))
         messages.append({"role": "user", "content": context})
         answ = self.gpt.json_gpt(messages, 16380)
         answer = json.loads(answ)
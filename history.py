@@ -0,0 +1,110 @@
+"""
+    Class History for keeping the chat history that is replayed to the model within a token budget.
+    1. compact: replaces the older turns of a chat with a rolling summary which is stored in the database and only extended
+       when the verbatim turns grow past the budget, so the summary is not recomputed on every request.
+    2. fit: picks the summary and the most recent turns that fit in the token budget of a single stage. The newest turn is
+       always kept (its answer shortened when it is larger than the budget) since follow-up questions refer to it.
+    3. messages: the chat messages for a stage, built from the turns returned by fit.
+
+"""
+
+import json
+from gpt import GPT
+
+class History:
+    def __init__(self, database=None, budget=4000):
+        self.database = database
+        self.budget = budget
+        self.gpt = GPT()
+        self.summarizer = """
+        You are part of an AI-powered legal research tool. You are given the summary of the earlier part of a chat between a user
+        and the tool (which can be empty) and the turns that followed it. Write one updated summary of the whole conversation that
+        keeps the user's facts, questions, the legal areas discussed and the key conclusions, citations and sections that were given
+        in the answers. The summary should be less than 400 words. Return a json format response with structure {'summary':the summary}.
+        """
+
+    # drop the parts of an answer that are only needed for display
+    @staticmethod
+    def clean(message):
+        system = message['system']
+        if isinstance(system, dict):
+            system = {k: v for k, v in system.items() if k not in ('citations', 'phrases', 'research', 'timings')}
+        cleaned = {'user': message['user'], 'system': system}
+        if message.get('summary'):
+            cleaned['summary'] = True
+        return cleaned
+
+    def tokens(self, message):
+        return self.gpt.count_tokens(str(message['user'])) + self.gpt.count_tokens(str(message['system']))
+
+    def summarize(self, summary, turns):
+        conversation = [{'user': message['user'], 'answer': message['system']} for message in turns]
+        messages = [{"role": "system", "content": self.summarizer}]
+        messages.append({"role": "user", "content": "Summary: " + summary + "\n Turns: " + str(conversation)})
+        answ = self.gpt.json_gpt(messages, 1000)
+        answer = json.loads(answ)
+        return answer['summary']
+
+    # replace the older turns of a chat with its rolling summary
+    def compact(self, chat_id, history):
+        history = [self.clean(message) for message in history]
+        stored = self.database.chat_summary(chat_id) if self.database else None
+        upto = 0
+        summary = ''
+        if stored and stored['upto'] <= len(history):
+            upto = stored['upto']
+            summary = stored['summary']
+        sizes = [self.tokens(message) for message in history]
+        if sum(sizes[upto:]) > self.budget:
+            #fold turns into the summary until the verbatim part is half the budget
+            start = upto
+            while upto < len(history) - 1 and sum(sizes[upto:]) > self.budget // 2:
+                upto = upto + 1
+            try:
+                summary = self.summarize(summary, history[start:upto])
+                if self.database:
+                    self.database.save_summary(chat_id, upto, summary)
+            except Exception as e:
+                print("Error summarizing chat: " + str(e))
+                upto = start
+        if upto == 0:
+            return history
+        return [{'user': 'Summary of the earlier conversation', 'system': summary, 'summary': True}] + history[upto:]
+
+    # a turn cut down to budget tokens, the question is kept and the end of the answer is dropped
+    def shorten(self, message, budget):
+        if self.tokens(message) <= budget:
+            return message
+        user = self.gpt.truncate_tokens(str(message['user']), budget)
+        system = self.gpt.truncate_tokens(str(message['system']), budget - self.gpt.count_tokens(user) - 1)
+        return {'user': user, 'system': system + ' ...' if system else ''}
+
+    # the summary (if any) and the most recent turns that fit in the budget
+    def fit(self, history, budget):
+        history = [self.clean(message) for message in history]
+        head = [message for message in history[:1] if message.get('summary')]
+        turns = history[len(head):]
+        used = sum(self.tokens(message) for message in head)
+        if not turns:
+            return head if used <= budget else []
+        #the newest turn comes first, the summary is dropped when it would leave less than half the budget for it
+        if budget - used < budget // 2 and self.tokens(turns[-1]) > budget - used:
+            head = []
+            used = 0
+        newest = self.shorten(turns[-1], budget - used)
+        used = used + self.tokens(newest)
+        kept = [newest]
+        for message in reversed(turns[:-1]):
+            size = self.tokens(message)
+            if used + size > budget:
+                break
+            kept.append(message)
+            used = used + size
+        return head + list(reversed(kept))
+
+    def messages(self, history, budget):
+        messages = []
+        for message in self.fit(history, budget):
+            messages.append({"role": "user", "content": message['user']})
+            messages.append({"role": "assistant", "content": str(message['system'])})
+        return messages
@@ -0,0 +1,186 @@
+"""
+    Class Ingest for processing every unprocessed file of a table in one run instead of one /proc_file call per file.
+    The files go through a pipeline of stages, each with its own parallelism:
+    1. parse: the text of the file is extracted with Collector (through Documents), parse_workers files at a time.
+    2. extract: the ruling or legislation is analysed by the AI, extract_workers files at a time.
+    3. embedd and store: the records of finished files are embedded embedd_batch texts at a time and added to the table
+       insert_batch records at a time.
+
+    Progress is checkpointed in ../ingest/<table>-<table_id>/: the analysis of every file is saved as soon as it is done and
+    checkpoint.json lists the files that were stored, so a run that crashed resumes without paying for the analysis again and
+    without adding the same vectors twice. Throughput is reported in documents per minute. Every batch that changes the table
+    bumps the corpus version of AnswerCache, from the command line as well as from the ingest job.
+
+    From the command line: python ingest.py <table_id> [--parse-workers 4] [--extract-workers 4] [--embedd-batch 512]
+"""
+
+import time
+import queue
+import argparse
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from file_control import File_Control
+from documents import Documents
+from process import Process
+from euclid import Euclid
+from tracing import Tracing
+from cache import AnswerCache
+
+class Ingest:
+    def __init__(self, table_id, parse_workers=4, extract_workers=4, embedd_batch=512, insert_batch=256):
+        self.table_id = table_id
+        self.parse_workers = parse_workers
+        self.extract_workers = extract_workers
+        self.embedd_batch = embedd_batch
+        self.insert_batch = insert_batch
+        self.proc = Process()
+        self.lock = threading.Lock()
+        tables = File_Control.open('../tables/root.pkl')
+        self.tab = next(item for item in tables if item['id'] == table_id)
+        self.table = self.tab['name']
+        self.folder = '../ingest/' + self.table + '-' + table_id + '/'
+        self.checkpoint_path = self.folder + 'checkpoint.json'
+
+    def load_checkpoint(self):
+        if File_Control.check_path(self.checkpoint_path):
+            return File_Control.load_json(self.checkpoint_path)
+        return {'stored': [], 'storing': [], 'failed': {}}
+
+    def save_checkpoint(self, checkpoint):
+        File_Control.save_json(self.checkpoint_path, checkpoint)
+
+    # the files of the table that still have to be processed
+    def pending(self, checkpoint):
+        files = File_Control.open('../tables/files.pkl')
+        return [file for file in files if file['table_id'] == self.table_id and not file['isProcessed']
+                and file['file_id'] not in checkpoint['stored']]
+
+    def parse(self, file):
+        return Documents.open(self.table, self.table_id, file['file_id'], file['filename'])
+
+    # analysis of a file by the AI, saved so that a resumed run does not repeat it
+    def extract(self, file, document):
+        saved = self.folder + file['file_id'] + '.pkl'
+        if File_Control.check_path(saved):
+            return File_Control.open(saved)
+        if self.tab['type'] == 'ruling':
+            content = self.proc.court_content(document)
+            records = self.proc.court_records(self.table_id, file['file_id'], file['filename'], content)
+        elif self.tab['type'] == 'legislation':
+            content = self.proc.sectioning(document)
+            records = self.proc.legislation_records(self.table_id, file['file_id'], file['filename'], content)
+        else:
+            raise ValueError('method for processing does not exist')
+        run = {'content': content, 'records': records}
+        File_Control.save(saved, run)
+        return run
+
+    def run(self, progress=None):
+        progress = progress or (lambda fraction, message='': None)
+        File_Control.create_path(self.folder)
+        checkpoint = self.load_checkpoint()
+        if checkpoint['storing']:
+            #the last run stopped while storing these files, remove what it added
+            vector = Euclid()
+            for file_id in checkpoint['storing']:
+                vector.delete(self.table, 'file_id', file_id)
+            checkpoint['storing'] = []
+            self.save_checkpoint(checkpoint)
+            AnswerCache.bump()
+        files = self.pending(checkpoint)
+        total = len(files)
+        started = time.time()
+        if total == 0:
+            return {'result': 'success', 'processed': 0, 'failed': len(checkpoint['failed']), 'docs_per_minute': 0.0}
+
+        finished = queue.Queue()
+        parse_pool = ThreadPoolExecutor(max_workers=self.parse_workers, thread_name_prefix='parse')
+        extract_pool = ThreadPoolExecutor(max_workers=self.extract_workers, thread_name_prefix='extract')
+
+        def extract(file, document):
+            try:
+                with Tracing.span('ingest.extract'):
+                    finished.put((file, self.extract(file, document), None))
+            except Exception as e:
+                finished.put((file, None, traceback.format_exc(limit=3)))
+
+        def parse(file):
+            try:
+                with Tracing.span('ingest.parse'):
+                    document = self.parse(file)
+                if not document:
+                    raise ValueError('no text extracted from ' + file['filename'])
+                extract_pool.submit(Tracing.propagate(extract), file, document)
+            except Exception as e:
+                finished.put((file, None, traceback.format_exc(limit=3)))
+
+        for file in files:
+            parse_pool.submit(Tracing.propagate(parse), file)
+
+        processed = 0
+        failed = 0
+        batch = []
+        try:
+            for n in range(total):
+                file, run, error = finished.get()
+                if error:
+                    print('Ingest failed for ' + file['filename'] + ': ' + error)
+                    checkpoint['failed'][file['file_id']] = error
+                    self.save_checkpoint(checkpoint)
+                    failed = failed + 1
+                else:
+                    checkpoint['failed'].pop(file['file_id'], None)
+                    batch.append((file, run))
+                if batch and (sum(len(run['records']) for file, run in batch) >= self.embedd_batch or n == total - 1):
+                    self.flush(batch, checkpoint)
+                    processed = processed + len(batch)
+                    batch = []
+                rate = processed / max(time.time() - started, 1e-9) * 60
+                progress((n + 1) / total, str(processed) + ' processed, ' + str(failed) + ' failed, ' + str(round(rate, 2)) + ' docs/minute')
+        finally:
+            parse_pool.shutdown(wait=False, cancel_futures=True)
+            extract_pool.shutdown(wait=False, cancel_futures=True)
+
+        minutes = (time.time() - started) / 60
+        rate = processed / minutes if minutes else 0.0
+        print('Ingested ' + str(processed) + ' documents of ' + self.table + ' at ' + str(round(rate, 2)) + ' docs/minute')
+        return {'result': 'success', 'processed': processed, 'failed': failed, 'docs_per_minute': round(rate, 2),
+                'minutes': round(minutes, 2)}
+
+    # embedd and store the records of finished files, then mark the files as processed
+    def flush(self, batch, checkpoint):
+        records = [record for file, run in batch for record in run['records']]
+        with Tracing.span('ingest.embedd', records=len(records)):
+            self.proc.embedd(records)
+        checkpoint['storing'] = [file['file_id'] for file, run in batch]
+        self.save_checkpoint(checkpoint)
+        with Tracing.span('ingest.store', records=len(records)):
+            self.proc.store(self.table, records, self.insert_batch)
+        for file, run in batch:
+            File_Control.save('../data/' + self.table + '-' + self.table_id + '/' + file['file_id'] + '-' + file['filename'] + '.pkl', run['content'])
+        with self.lock:
+            files = File_Control.open('../tables/files.pkl')
+            done = set(checkpoint['storing'])
+            for file in files:
+                if file['file_id'] in done:
+                    file['isProcessed'] = True
+            File_Control.save('../tables/files.pkl', files)
+        AnswerCache.bump()
+        checkpoint['stored'].extend(checkpoint['storing'])
+        checkpoint['storing'] = []
+        self.save_checkpoint(checkpoint)
+        for file, run in batch:
+            File_Control.delete_file(self.folder + file['file_id'] + '.pkl')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Process every unprocessed file of a table')
+    parser.add_argument('table_id')
+    parser.add_argument('--parse-workers', type=int, default=4)
+    parser.add_argument('--extract-workers', type=int, default=4)
+    parser.add_argument('--embedd-batch', type=int, default=512)
+    parser.add_argument('--insert-batch', type=int, default=256)
+    args = parser.parse_args()
+    ingest = Ingest(args.table_id, args.parse_workers, args.extract_workers, args.embedd_batch, args.insert_batch)
+    print(ingest.run(lambda fraction, message='': print(str(round(fraction * 100, 1)) + '% ' + message)))
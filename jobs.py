@@ -0,0 +1,122 @@
+"""
+    Class Jobs for running long LLM and ingestion work (processing files, deploying the graph, research answers) outside of
+    the web request that asked for it.
+    1. register: names a function that can run as a job, it is called with the params of the job and a progress function.
+    2. submit: stores a job of a user in the jobs table of the datastore and queues it on the worker pool, the id is returned
+       at once. Only the user that submitted a job may read or retry it.
+    3. status: the status (queued, running, done or failed), progress, message, result and error of a job.
+    4. retry: queues a failed job again.
+    5. start: starts a monitor thread, call it once per process when the app starts. Every heartbeat seconds it records that
+       the jobs of this process are still running and recovers jobs left behind: queued jobs are queued on this pool too
+       (claim makes sure only one worker runs a job) and a running job is queued again only when the process running it
+       has not been heard from for stale seconds. Jobs still running in another worker process are never run twice.
+
+"""
+
+import os
+import json
+import time
+import socket
+import secrets
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from tracing import Tracing
+
+class Jobs:
+    def __init__(self, database, workers=2, heartbeat=30, stale=120):
+        self.database = database
+        self.functions = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.heartbeat = heartbeat
+        self.stale = stale
+        #this process, the random part tells apart processes that reuse a pid after a restart
+        self.worker = socket.gethostname() + ':' + str(os.getpid()) + ':' + secrets.token_hex(4)
+        #jobs on this pool that have not started yet
+        self.waiting = set()
+        self.lock = threading.Lock()
+        self.monitor = None
+
+    def register(self, kind, function):
+        self.functions[kind] = function
+
+    def submit(self, kind, params, user_id=None):
+        if kind not in self.functions:
+            return {'status': 'Error: unknown job ' + kind}
+        add = self.database.add_job(kind, params, user_id)
+        if add['status'] != 'success':
+            return add
+        self.queue(add['job_id'])
+        return {'status': 'queued', 'job_id': add['job_id']}
+
+    def queue(self, job_id):
+        with self.lock:
+            if job_id in self.waiting:
+                return
+            self.waiting.add(job_id)
+        self.pool.submit(self.run, job_id)
+
+    def status(self, job_id):
+        return self.database.job(job_id)
+
+    def retry(self, job_id):
+        job = self.database.job(job_id)
+        if job is None:
+            return {'status': 'Error: job not found'}
+        if job['status'] != 'failed':
+            return {'status': 'Error: only failed jobs can be retried, job is ' + job['status']}
+        self.database.update_job(job_id, status='queued', progress=0.0, message='', error=None)
+        self.queue(job_id)
+        return {'status': 'queued', 'job_id': job_id}
+
+    def start(self):
+        with self.lock:
+            if self.monitor is not None:
+                return
+            self.monitor = threading.Thread(target=self.watch, daemon=True, name='jobs-monitor')
+        self.monitor.start()
+
+    def watch(self):
+        while True:
+            try:
+                self.database.beat_jobs(self.worker)
+                self.recover()
+            except Exception as e:
+                traceback.print_exc()
+            time.sleep(self.heartbeat)
+
+    # queue the jobs no worker is taking care of, the number of jobs queued is returned
+    def recover(self):
+        recovered = 0
+        for job in self.database.unfinished_jobs():
+            if job['status'] == 'running':
+                if job['worker'] == self.worker:
+                    continue
+                #the process running the job stopped, requeue_job fails when another worker requeued it first
+                if not self.database.requeue_job(job['job_id'], time.time() - self.stale):
+                    continue
+            if job['job_id'] not in self.waiting:
+                self.queue(job['job_id'])
+                recovered = recovered + 1
+        return recovered
+
+    def run(self, job_id):
+        with self.lock:
+            self.waiting.discard(job_id)
+        if not self.database.claim_job(job_id, self.worker):
+            return
+        job = self.database.job(job_id)
+        Tracing.start(job_id)
+        def progress(fraction, message=''):
+            self.database.update_job(job_id, progress=round(fraction, 3), message=message)
+        try:
+            with Tracing.span('job.' + job['kind']):
+                result = self.functions[job['kind']](progress=progress, **job['params'])
+            #results are stored as json
+            json.dumps(result)
+            self.database.update_job(job_id, status='done', progress=1.0, result=result)
+            Tracing.count('jobs_total', kind=job['kind'], status='done')
+        except Exception as e:
+            traceback.print_exc()
+            self.database.update_job(job_id, status='failed', error=traceback.format_exc(limit=5))
+            Tracing.count('jobs_total', kind=job['kind'], status='failed')
@@ -0,0 +1,197 @@
+"""
+    Lexical (word based) scoring of texts against a query, without calling the embeddings model.
+    1. BM25: scores a list of texts held in memory for a query, texts without any of the query words score 0.
+       tokenize gives the lower case words and numbers of a text without the most common english words.
+    2. LexicalIndex: an inverted index of the records of every Euclid table stored in ../euclid/lexical.db, searched with BM25
+       so that exact tokens like case numbers, section numbers and party names are found even when cosine search misses them.
+       The state of the index of every table is kept next to it: 'ready' once all its records are indexed, 'building' while
+       a backfill runs (claim lets only one process start it) and 'failed' when the backfill stopped.
+
+"""
+
+import re
+import time
+import math
+import sqlite3
+from collections import Counter
+from file_control import File_Control
+
+STOPWORDS = set("""
+a an and are as at be by for from has have in is it its of on or that the this to was were will with which who whom
+whose what when where why how not no but if then than so such these those there their they them he she his her
+i me my we our you your do does did done been being into out over under up down any all can may shall should would
+""".split())
+
+class BM25:
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.frequencies = [Counter(tokens) for tokens in texts]
+        self.lengths = [len(tokens) for tokens in texts]
+        self.avgdl = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        self.df = Counter()
+        for frequency in self.frequencies:
+            self.df.update(frequency.keys())
+
+    @staticmethod
+    def tokenize(text):
+        return [word for word in re.findall(r"[a-z0-9]+", str(text).lower()) if (len(word) > 1 or word.isdigit()) and word not in STOPWORDS]
+
+    @staticmethod
+    def idf(n, df):
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def scores(self, query):
+        n = len(self.frequencies)
+        terms = set(query)
+        results = []
+        for frequency, length in zip(self.frequencies, self.lengths):
+            score = 0.0
+            for term in terms:
+                tf = frequency.get(term, 0)
+                if tf:
+                    norm = self.k1 * (1 - self.b + self.b * length / (self.avgdl or 1))
+                    score += BM25.idf(n, self.df[term]) * tf * (self.k1 + 1) / (tf + norm)
+            results.append(score)
+        return results
+
+
+class LexicalIndex:
+    def __init__(self, path='../euclid/lexical.db'):
+        self.db_path = path
+        File_Control.create_path('../euclid/')
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS docs
+                              (tab TEXT, id TEXT, length INTEGER, PRIMARY KEY (tab, id))''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS postings
+                              (tab TEXT, term TEXT, id TEXT, tf INTEGER)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS postings_term ON postings (tab, term)''')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS postings_id ON postings (tab, id)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS indexed
+                              (tab TEXT PRIMARY KEY, state TEXT, updated_at REAL)''')
+            conn.commit()
+
+    # index (or re-index) records of a table
+    def add(self, table, ids, texts):
+        docs = []
+        postings = []
+        for id_, text in zip(ids, texts):
+            frequency = Counter(BM25.tokenize(text))
+            docs.append((table, id_, sum(frequency.values())))
+            postings.extend((table, term, id_, tf) for term, tf in frequency.items())
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.executemany("DELETE FROM postings WHERE tab=? AND id=?", [(table, id_) for id_ in ids])
+                cursor.executemany("INSERT OR REPLACE INTO docs (tab, id, length) VALUES (?, ?, ?)", docs)
+                cursor.executemany("INSERT INTO postings (tab, term, id, tf) VALUES (?, ?, ?, ?)", postings)
+                conn.commit()
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+
+    def delete(self, table, ids):
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.executemany("DELETE FROM postings WHERE tab=? AND id=?", [(table, id_) for id_ in ids])
+                cursor.executemany("DELETE FROM docs WHERE tab=? AND id=?", [(table, id_) for id_ in ids])
+                conn.commit()
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+
+    def drop(self, table):
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM postings WHERE tab=?", (table,))
+                cursor.execute("DELETE FROM docs WHERE tab=?", (table,))
+                cursor.execute("DELETE FROM indexed WHERE tab=?", (table,))
+                conn.commit()
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+
+    def count(self, table):
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM docs WHERE tab=?", (table,))
+            return cursor.fetchone()[0]
+
+    def ids(self, table):
+        with sqlite3.connect(self.db_path, timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM docs WHERE tab=?", (table,))
+            return {row[0] for row in cursor.fetchall()}
+
+    # set the state of the index of a table, 'ready' when all its records are indexed
+    def mark(self, table, state='ready'):
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.execute("INSERT OR REPLACE INTO indexed (tab, state, updated_at) VALUES (?, ?, ?)", (table, state, time.time()))
+                conn.commit()
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+
+    def ready(self, table):
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT state FROM indexed WHERE tab=?", (table,))
+                row = cursor.fetchone()
+                return row is not None and row[0] == 'ready'
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+            return False
+
+    # start building the index of a table, False when it is ready or another process is building it (and was heard
+    # from within stale seconds)
+    def claim(self, table, stale=600):
+        now = time.time()
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT INTO indexed (tab, state, updated_at) VALUES (?, 'building', ?)
+                                  ON CONFLICT(tab) DO UPDATE SET state='building', updated_at=excluded.updated_at
+                                  WHERE indexed.state!='ready' AND (indexed.state!='building' OR indexed.updated_at<?)''',
+                               (table, now, now - stale))
+                conn.commit()
+                return cursor.rowcount == 1
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+            return False
+
+    # the ids and BM25 scores of the k best records of a table for a query
+    def search(self, table, query, k=10, k1=1.5, b=0.75):
+        terms = set(BM25.tokenize(query))
+        if not terms:
+            return []
+        try:
+            with sqlite3.connect(self.db_path, timeout=30) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*), AVG(length) FROM docs WHERE tab=?", (table,))
+                n, avgdl = cursor.fetchone()
+                if not n:
+                    return []
+                matches = {}
+                for term in terms:
+                    cursor.execute("SELECT id, tf FROM postings WHERE tab=? AND term=?", (table, term))
+                    rows = cursor.fetchall()
+                    if rows:
+                        matches[term] = rows
+                ids = list({id_ for rows in matches.values() for id_, tf in rows})
+                lengths = {}
+                for i in range(0, len(ids), 500):
+                    batch = ids[i:i+500]
+                    cursor.execute("SELECT id, length FROM docs WHERE tab=? AND id IN (" + ','.join('?' * len(batch)) + ")", [table] + batch)
+                    lengths.update(cursor.fetchall())
+        except Exception as e:
+            print("Lexical index error: " + str(e))
+            return []
+        scores = {}
+        for term, rows in matches.items():
+            idf = BM25.idf(n, len(rows))
+            for id_, tf in rows:
+                norm = k1 * (1 - b + b * lengths.get(id_, 0) / (avgdl or 1))
+                scores[id_] = scores.get(id_, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:k]
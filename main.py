@@ -1,7 +1,9 @@
-from flask import Flask, request, render_template,send_file, jsonify, make_response
+from flask import Flask, request, render_template,send_file, jsonify, make_response, Response, stream_with_context
 from datetime import datetime
 from fuzzywuzzy import fuzz, process
 import traceback
+import threading
+import queue
 import requests
 import json
 import random
@@ -15,7 +17,7 @@ from flask_limiter.util import get_remote_address
 #local libraries
 from database import Database
 from file_control import File_Control
-from collector import Collector
+from documents import Documents
 from process import Process
 from euclid import Euclid
 from graph import Graph
@@ -23,9 +25,17 @@ from assist import Assist
 from rag import RAG
 from ads import Ads
 from auth import auth
+from history import History
+from tracing import Tracing
+from cache import EmbeddingCache, AnswerCache
+from gpt import GPT
+from jobs import Jobs
+from ingest import Ingest
 
 database=Database()
 collections=Euclid()
+memory=History(database)
+jobs=Jobs(database)
 
 app = Flask(__name__)
 CORS(app)
@@ -46,6 +56,39 @@ CORS(app)
 
 
 
+#trace every request under an id, the client can pass its own in X-Request-ID
+@app.before_request
+def start_trace():
+  Tracing.start(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def end_trace(response):
+  response.headers['X-Request-ID']=Tracing.request_id()
+  return response
+
+#attach the timings of the request to an answer when the client asked for them
+def with_timings(answer, data):
+  if not data.get('timings'):
+    return answer
+  ans=json.loads(answer)
+  ans['timings']=Tracing.timings()
+  return json.dumps(ans)
+
+#latency and token histograms in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+  Tracing.gauge('cache_hits', EmbeddingCache.hits, cache='embeddings')
+  Tracing.gauge('cache_misses', EmbeddingCache.misses, cache='embeddings')
+  if GPT.responses is not None:
+    stats=GPT.responses.stats()
+    Tracing.gauge('cache_hits', stats['hits']+stats['disk_hits'], cache='responses')
+    Tracing.gauge('cache_misses', stats['misses'], cache='responses')
+  if AnswerCache.shared_cache is not None:
+    stats=AnswerCache.shared_cache.stats()
+    Tracing.gauge('cache_hits', stats['hits'], cache='answers')
+    Tracing.gauge('cache_misses', stats['misses'], cache='answers')
+  return Response(Tracing.metrics(), mimetype='text/plain')
+
 #--------------------------------------------------------------------------------------------------------------
 # AUTH AND ACCOUNT MANAGEMENT
 
@@ -455,8 +498,9 @@ def run_playground(decoded_token):
     document=''
     if 'document' in data:
       document=data.get('document')
-    history = database.messages(chat)
+    history = memory.compact(chat, database.messages(chat))
     answer, sources = rag.single_step(prompt, history, 3, 3)
+    answer = with_timings(answer, data)
     ads=Ads()
     ad=ads.random_advertiser()
     #add ad to viewership
@@ -497,11 +541,20 @@ def run_assist(decoded_token):
     messages = database.messages(chat)
     chats = database.chats(user)
     return {"messages": messages, "chats": chats, "current": chat,"warning":billing['status']}
-  # Execute
+  if data.get('background'):
+    job=jobs.submit('assist', {'user':user, 'chat':chat, 'prompt':prompt, 'timings':bool(data.get('timings'))}, user)
+    job['current']=chat
+    return job
+  return assist_answer(user, chat, prompt, data.get('timings'))
+
+#answer a prompt of the assistant and add it to the chat
+def assist_answer(user, chat, prompt, timings=False, progress=None):
+  rag=RAG(collections)
   try:
-    history = database.messages(chat)
+    history = memory.compact(chat, database.messages(chat))
     #answer, sources = assist.run(prompt, history)
     answer, sources = rag.single_step(prompt, history, 3, 5)
+    answer = with_timings(answer, {'timings':timings})
   except Exception as e:
     traceback.print_exc()
     p={"answer":[{"type":"paragraph","data":"Error generating content, please try again. If the error persist create a new workspace."}],"sources":[], "citations":[]}
@@ -515,6 +568,102 @@ def run_assist(decoded_token):
 
   return {"messages": messages, "chats": chats, "current": chat}
 
+#format an event for a server-sent events stream
+def sse(event, data):
+  return 'event: '+event+'\ndata: '+json.dumps(data)+'\n\n'
+
+#stream the answer to a prompt, the final answer is saved to the chat like /play and /assist do
+#the answer is produced on its own thread so it is still finished and saved when the client disconnects mid-stream
+def stream_answer(user, chat, prompt, k, scope, with_ads, timings=False):
+  events=queue.Queue()
+  def produce():
+    rag=RAG(collections)
+    answer=None
+    ad={}
+    try:
+      history = memory.compact(chat, database.messages(chat))
+      for event in rag.single_step_stream(prompt, history, k, scope):
+        if event['event']=='done':
+          answer=event['answer']
+        else:
+          events.put(sse(event['event'], event['data']))
+      if with_ads:
+        ads=Ads()
+        ad=ads.random_advertiser()
+        add_ad=database.add_ad_view(ad['id'], user, chat)
+    except Exception as e:
+      traceback.print_exc()
+      p={"answer":[{"type":"paragraph","data":"Error generating content, please try again. If the error persist create a new workspace."}],"sources":[], "citations":[]}
+      answer=json.dumps(p)
+      ad={}
+    # Add answer to database
+    add = database.add_message(chat, user, str(answer), prompt)
+    messages = database.messages(chat)
+    chats = database.chats(user)
+    done={"messages": messages, "chats": chats, "current": chat}
+    if with_ads:
+      done['ads']=ad
+    if timings:
+      done['timings']=Tracing.timings()
+    events.put(sse('done', done))
+
+  def run():
+    try:
+      produce()
+    finally:
+      #the end of the stream, also when saving failed
+      events.put(None)
+
+  def generate():
+    yield sse('chat', {'current': chat})
+    while True:
+      event=events.get()
+      if event is None:
+        return
+      yield event
+
+  threading.Thread(target=Tracing.propagate(run), daemon=True).start()
+  headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'}
+  return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+#playground, streamed as server-sent events
+@app.route('/play_stream', methods=['POST'])
+@auth.jwt_required()
+def run_playground_stream(decoded_token):
+  data = request.get_json()
+  chat = data.get('chat_id')
+  user = decoded_token['user_id']
+  prompt = data.get('prompt')
+  # Check if there is a valid chat or it's a new one
+  if chat == '' or chat is None:
+    rag= RAG(collections)
+    name = rag.naming(prompt)
+    add = database.add_chat(user, name)
+    chat = add['chat']
+  return stream_answer(user, chat, prompt, 3, 3, True, data.get('timings'))
+
+#assistant, streamed as server-sent events
+@app.route('/assist_stream', methods=['POST'])
+@auth.jwt_required()
+def run_assist_stream(decoded_token):
+  data = request.get_json()
+  chat = data.get('chat_id')
+  user = decoded_token['user_id']
+  prompt = data.get('prompt')
+  # Check if there is a valid chat or it's a new one
+  if chat == '' or chat is None:
+    rag=RAG(collections)
+    name = rag.naming(prompt)
+    add = database.add_chat(user, name)
+    chat = add['chat']
+  #check for billing
+  billing=database.billing(user)
+  if billing['status']!='success':
+    messages = database.messages(chat)
+    chats = database.chats(user)
+    return {"messages": messages, "chats": chats, "current": chat,"warning":billing['status']}
+  return stream_answer(user, chat, prompt, 3, 5, False, data.get('timings'))
+
 #retrieve all ads for an advertiser
 @app.route('/ads', methods=['GET'])
 def show_ads():
@@ -659,10 +808,13 @@ def create_table():
   data = request.get_json()
   name=data.get('name')
   type=data.get('type')
+  #'chroma' (default) or 'matrix' for exact search on small and medium tables
+  engine=data.get('engine','chroma')
+  dtype=data.get('dtype','float32')
   #view what is in the tables
   tables=File_Control.open('../tables/root.pkl')
   vector=Euclid()
-  add=vector.create_table(name)
+  add=vector.create_table(name,engine=engine,dtype=dtype)
   if add=='success':
     table_id=str(random.randint(1000,9999))
     table={"id":table_id,"name":name,"type":type,'count':0}
@@ -677,6 +829,14 @@ def create_table():
   else:
     return {"result":"error creating vector database table, check table name","tables":tables}
 
+#move a table to another search engine ('chroma' or 'matrix')
+@app.route('/table_engine', methods=['POST'])
+def table_engine():
+  data = request.get_json()
+  vector=Euclid()
+  result=vector.set_engine(data.get('name'),data.get('engine'),data.get('dtype','float32'))
+  return {'result':result,'engines':Euclid.engines()}
+
 #delete a table
 @app.route('/delete_table', methods=['GET'])
 def delete_table():
@@ -695,6 +855,9 @@ def delete_table():
     tables=File_Control.open('../tables/root.pkl')
     File_Control.delete_path('../temp/'+name+'-'+table+'/')
     File_Control.delete_path('../data/'+name+'-'+table+'/')
+    File_Control.delete_path('../extracted/'+name+'-'+table+'/')
+    File_Control.delete_path('../ingest/'+name+'-'+table+'/')
+    AnswerCache.bump()
 
     return {'tables':tables}
   else:
@@ -765,6 +928,8 @@ def delete_file_unprocessed():
       File_Control.save('../tables/files.pkl',new_files)
       File_Control.delete_file('../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename)
       File_Control.delete_file('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl')
+      Documents.forget(table, table_id, file_id)
+      AnswerCache.bump()
       new_files=files[-100:]
       return {'files':new_files}
     else:
@@ -774,6 +939,7 @@ def delete_file_unprocessed():
     new_files=[item for item in files if item['file_id'] != file_id]
     File_Control.save('../tables/files.pkl',new_files)
     File_Control.delete_file('../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename)
+    Documents.forget(table, table_id, file_id)
     new_files=files[-100:]
     return {'files':new_files}
 
@@ -796,6 +962,8 @@ def delete_file():
     File_Control.save('../tables/files.pkl',new_files)
     File_Control.delete_file('../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename)
     File_Control.delete_file('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl')
+    Documents.forget(table, table_id, file_id)
+    AnswerCache.bump()
     return {'files':new_files}
   else:
     return {'files':files}
@@ -803,32 +971,27 @@ def delete_file():
 #process a file
 @app.route('/proc_file', methods=['GET'])
 def proc_file():
-  file_id=request.args.get('file_id')
-  filename=request.args.get('filename')
-  table_id=request.args.get('table_id')
-  table=request.args.get('table')
-  file_path='../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename
-  collect=Collector()
+  params={'table':request.args.get('table'),'table_id':request.args.get('table_id'),
+          'file_id':request.args.get('file_id'),'filename':request.args.get('filename')}
+  if background():
+    return submit_job('proc_file', params)
+  return process_file(**params)
+
+#process a file with the AI and add it to its table
+def process_file(table, table_id, file_id, filename, progress=None):
+  progress=progress or (lambda fraction, message='': None)
   #process document using the AI
   proc=Process()
   tables=File_Control.open('../tables/root.pkl')
   tab=next(item for item in tables if item['id'] == table_id)
+  #extracted once here, research and file viewing reuse the stored extraction
+  progress(0.05, 'extracting text')
+  document=Documents.open(table, table_id, file_id, filename)
+  progress(0.1, 'processing')
   if tab['type']=='ruling':
-    if filename.lower().endswith('.pdf'):
-      document=collect.pdf_raw(file_path)
-    elif filename.lower().endswith('.docx'):
-      document=collect.collect_docx(file_path)
     run=proc.court_proc(table, table_id, file_id, filename, document)
   elif tab['type']=='legislation':
-    if filename.lower().endswith('.htm') or filename.lower().endswith('.html'):
-      document=collect.html_styles(file_path)
-      run=proc.legislation(table, table_id, file_id, filename, document)
-    elif filename.lower().endswith('.pdf'):
-      document=collect.pdf_raw(file_path)
-      run=proc.legislation(table, table_id, file_id, filename, document)
-    elif filename.lower().endswith('.docx'):
-      document=collect.docx_styles(file_path)
-      run=proc.legislation(table, table_id, file_id, filename, document)
+    run=proc.legislation(table, table_id, file_id, filename, document)
   else:
     #other methods of processing documents
     run={'result':'method for processing does not exist','content':{}}
@@ -839,6 +1002,7 @@ def proc_file():
     File_Control.save('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl',run['content'])
     next(item for item in files if item['file_id'] == file_id)['isProcessed'] = True
     File_Control.save('../tables/files.pkl',files)
+    AnswerCache.bump()
 
   else:
     print(run['result'])
@@ -847,6 +1011,18 @@ def proc_file():
   files=files[-100:]
   return {'result':run['result'],'files':files}
 
+#process every unprocessed file of a table, this always runs as a background job
+@app.route('/ingest', methods=['GET'])
+def ingest_table():
+  params={'table_id':request.args.get('table_id')}
+  for setting in ('parse_workers','extract_workers','embedd_batch','insert_batch'):
+    if request.args.get(setting):
+      params[setting]=int(request.args.get(setting))
+  return submit_job('ingest', params)
+
+def ingest(table_id, parse_workers=4, extract_workers=4, embedd_batch=512, insert_batch=256, progress=None):
+  return Ingest(table_id, parse_workers, extract_workers, embedd_batch, insert_batch).run(progress)
+
 #open a file
 @app.route('/open_file', methods=['GET'])
 def open_file():
@@ -860,15 +1036,7 @@ def open_file():
   cite=file['citation']
   graph=Graph()
   n=graph.search(cite)
-  file_path='../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename
-  collect=Collector()
-  if filename.lower().endswith('.pdf'):
-    document=collect.pdf_raw(file_path)
-  elif filename.lower().endswith('.docx'):
-    document=collect.docx_styles(file_path)
-  elif filename.lower().endswith('.htm') or filename.lower().endswith('.html'):
-    document=collect.html_styles(file_path)
-  file['raw']=document
+  file['raw']=Documents.open(table, table_id, file_id, filename)
   file['sections']=[]
   #print(file)
 
@@ -957,28 +1125,28 @@ def process_section():
 #section processing
 @app.route('/regenerate', methods=['GET'])
 def document_regenerate():
-  file_id=request.args.get('file_id')
-  filename=request.args.get('filename')
-  table_id=request.args.get('table_id')
-  table=request.args.get('table')
-  file_path='../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename
-  collect=Collector()
+  params={'table':request.args.get('table'),'table_id':request.args.get('table_id'),
+          'file_id':request.args.get('file_id'),'filename':request.args.get('filename')}
+  if background():
+    return submit_job('regenerate', params)
+  return regenerate_file(**params)
+
+#process a ruling again and replace its vectors
+def regenerate_file(table, table_id, file_id, filename, progress=None):
+  progress=progress or (lambda fraction, message='': None)
   #process document using the AI
   proc=Process()
-  document=collect.pdf_raw(file_path)
-  run=proc.court_proc(table, table_id, file_id, filename, document)
-  files=File_Control.open('../tables/files.pkl')
-  vector=Euclid()
-  deli=vector.delete(table,'file_id',file_id)
-  if deli=='success':
-    if run['result']=='success':
-      #add to table
-      File_Control.save('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl',run['content'])
-      return {'result':run['result'],'file':run['content']}
-    else:
-      return {'result':'Error re-generating from the AI'}
+  progress(0.05, 'processing')
+  document=Documents.open(table, table_id, file_id, filename)
+  #only the records that changed are written, stale ones are deleted
+  run=proc.court_update(table, table_id, file_id, filename, document)
+  if run['result']=='success':
+    AnswerCache.bump()
+    #add to table
+    File_Control.save('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl',run['content'])
+    return {'result':run['result'],'file':run['content']}
   else:
-    return {'result':'error deleting vector file'}
+    return {'result':'Error re-generating from the AI'}
 
 #upload changes to sections
 @app.route('/upload_changes', methods=['POST'])
@@ -989,19 +1157,25 @@ def upload_changes():
   table_id=data.get('table_id')
   table=data.get('table')
   document=data.get('document')
-  vector=Euclid()
-  deli=vector.delete(table,'file_id',file_id)
-  if deli=='success':
-    proc=Process()
-    run=proc.update_legi(table, table_id, file_id, filename, document)
-    if run=='success':
-      File_Control.delete_file('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl')
-      File_Control.save('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl',document)
-      return {'result':'success'}
-    else:
-      return {'result':'Error embedding and adding to vector database'}
+  params={'table':table,'table_id':table_id,'file_id':file_id,'filename':filename,'document':document}
+  if data.get('background'):
+    return submit_job('upload_changes', params)
+  return apply_changes(**params)
+
+#replace the sections of a legislation with edited ones
+def apply_changes(table, table_id, file_id, filename, document, progress=None):
+  progress=progress or (lambda fraction, message='': None)
+  progress(0.1, 'embedding changed sections')
+  #only the chunks of changed sections are written, stale ones are deleted
+  proc=Process()
+  run=proc.update_legi(table, table_id, file_id, filename, document)
+  AnswerCache.bump()
+  if run=='success':
+    File_Control.delete_file('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl')
+    File_Control.save('../data/'+table+'-'+table_id+'/'+file_id+'-'+filename+'.pkl',document)
+    return {'result':'success'}
   else:
-    return {'result':'Error deleting records from vector database'}
+    return {'result':'Error embedding and adding to vector database'}
 
 #do a raw search of the euclid database
 @app.route('/raw_search', methods=['POST'])
@@ -1009,8 +1183,17 @@ def raw_search():
   data = request.get_json()
   table=data.get('table')
   query=data.get('query')
+  #optional: several tables searched at once, a search mode and filters on file_id, table_id, citation, court and dates
+  filters=data.get('filters') or {}
+  where=Euclid.where(filters.get('file_id'),filters.get('table_id'),filters.get('citation'),filters.get('court'),
+                     filters.get('date_from'),filters.get('date_to'))
+  mode=data.get('mode','vector')
+  k=int(data.get('k',10))
   vector=Euclid()
-  r=vector.search(table,query,10)
+  if data.get('tables'):
+    r=vector.search_tables(data.get('tables'),query,k,mode,where)
+  else:
+    r=vector.search(table,query,k,mode,where)
 
   return {'documents':r}
 
@@ -1040,6 +1223,12 @@ def typing_search():
 #deploy all documents into graph
 @app.route('/deploy_graph', methods=['GET'])
 def deploy_all_documents_to_graph():
+  if background():
+    return submit_job('deploy_graph', {})
+  return deploy_graph()
+
+#build the graph from all the files
+def deploy_graph(progress=None):
   #check if files object exist
   tables=File_Control.open('../tables/root.pkl')
   files=File_Control.open('../tables/files.pkl')
@@ -1062,6 +1251,50 @@ def show_react_graph():
   flow=graph.graph_data()
   return flow
 
+#------------------------------------------------------------------------------------------------------------------
+# BACKGROUND JOBS
+
+#long running endpoints accept background=true to run as a job and return the job id at once
+def background():
+  flag=request.args.get('background')
+  if flag is None and request.is_json:
+    flag=(request.get_json(silent=True) or {}).get('background')
+  return str(flag).lower() in ('1','true','yes')
+
+#a job belongs to the user of the token sent with the request, only they can see its status and result
+def submit_job(kind, params):
+  decoded_token, error_response, status_code = auth.verify_token()
+  if error_response:
+    return error_response, status_code
+  return jobs.submit(kind, params, decoded_token['user_id'])
+
+jobs.register('proc_file', process_file)
+jobs.register('regenerate', regenerate_file)
+jobs.register('upload_changes', apply_changes)
+jobs.register('deploy_graph', deploy_graph)
+jobs.register('assist', assist_answer)
+jobs.register('ingest', ingest)
+jobs.start()
+
+#status, progress, result and error of a job
+@app.route('/jobs/<job_id>', methods=['GET'])
+@auth.jwt_required()
+def job_status(decoded_token, job_id):
+  job=jobs.status(job_id)
+  #jobs of other users are reported as missing
+  if job is None or job['user_id']!=decoded_token['user_id']:
+    return {'status':'Error: job not found'}, 404
+  return job
+
+#run a failed job again
+@app.route('/jobs/<job_id>/retry', methods=['POST'])
+@auth.jwt_required()
+def job_retry(decoded_token, job_id):
+  job=jobs.status(job_id)
+  if job is None or job['user_id']!=decoded_token['user_id']:
+    return {'status':'Error: job not found'}, 404
+  return jobs.retry(job_id)
+
 #------------
 if __name__=='__main__':
     app.run(host='0.0.0.0',port='8080')
@@ -0,0 +1,424 @@
+"""
+    Class MatrixTable, an exact search backend for Euclid tables of up to a few hundred thousand vectors.
+    The embeddings of a table are kept normalized in one contiguous float32 (or float16) matrix memory-mapped from a
+    vectors file in ../euclid/matrix/<table>/. A query is one matrix product with all the query vectors and argpartition for
+    the top k, so recall is exact and no index is built. float16 halves the file, queries run on a float32 copy of it held
+    in memory because converting the matrix on every query costs more than the product itself.
+
+    The ids, documents and metadata are kept in rows.pkl, a snapshot that is only ever replaced whole (written to a
+    temporary file first), and in a log next to it where every write appends the rows it changed. The log is folded into a
+    new snapshot once it is as large as the snapshot, so a write costs about the size of the rows it changes and a crash
+    leaves either the old or the new snapshot plus at most a torn last log entry, which is dropped.
+
+    Several processes (web workers, python ingest.py) can use the same table: writes take a lock on the folder and every
+    call first reads what other processes appended to the log (the snapshot and vectors are reloaded when they changed).
+
+    It has the part of the API of a chroma collection used by Euclid (add, upsert, query, get, delete, count) and returns
+    results in the same format, distances are cosine distances. where filters support the chroma operators $eq, $ne, $gt,
+    $gte, $lt, $lte, $in, $nin, $and and $or. Deleted rows are only marked until they are more than a quarter of the table.
+"""
+
+import os
+import pickle
+import secrets
+import threading
+import contextlib
+import numpy as np
+from file_control import File_Control
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+class MatrixTable:
+    def __init__(self, name, path='../euclid/matrix/', dtype='float32'):
+        self.name = name
+        self.folder = path + name + '/'
+        self.default_dtype = dtype
+        self.lock = threading.RLock()
+        self.locked = False
+        File_Control.create_path(self.folder)
+        with self.lock:
+            self._load()
+
+    # the folder lock shared with the other processes, held for writes and full reloads
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if self.locked:
+            yield
+            return
+        with open(self.folder + 'lock', 'a+b') as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            self.locked = True
+            try:
+                yield
+            finally:
+                self.locked = False
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    # the snapshot and its signature, None when the table has never been written
+    def _read_snapshot(self):
+        try:
+            f = open(self.folder + 'rows.pkl', 'rb')
+        except FileNotFoundError:
+            return None, None
+        with f:
+            stat = os.fstat(f.fileno())
+            try:
+                state = pickle.load(f)
+            except Exception as e:
+                #never start empty over a table that exists, the next write would replace its vectors
+                raise Exception('matrix table ' + self.name + ' could not be read: ' + str(e))
+        return state, (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _load(self):
+        with self._file_lock():
+            state, self.signature = self._read_snapshot()
+            state = state or {'dtype': self.default_dtype, 'dim': None, 'rows': [], 'vectors': None, 'log': None}
+            self.dtype = state['dtype']
+            self.dim = state['dim']
+            self.rows = state['rows']
+            self.vectors_name = state['vectors']
+            self.log_name = state['log']
+            self.offset = 0
+            self.positions = {row['id']: i for i, row in enumerate(self.rows) if row is not None}
+            self.vectors = None
+            self.matrix = None
+            self.mapped = None
+            self.capacity = 0
+            self.alive = np.zeros(0, dtype=bool)
+            self._map()
+            #live rows as a mask so unfiltered queries do not look at the rows one by one
+            self.alive[list(self.positions.values())] = True
+            self._replay()
+
+    # map the vectors file again when it was replaced or grew
+    def _map(self):
+        if self.vectors_name is None or self.dim is None:
+            return
+        path = self.folder + self.vectors_name
+        capacity = os.path.getsize(path) // (np.dtype(self.dtype).itemsize * self.dim)
+        if self.mapped == self.vectors_name and capacity == self.capacity:
+            return
+        previous = self.matrix if self.mapped == self.vectors_name else None
+        self.vectors = np.memmap(path, dtype=self.dtype, mode='r+', shape=(capacity, self.dim)) if capacity else None
+        if self.vectors is None:
+            self.matrix = None
+        elif np.dtype(self.dtype) == np.float32:
+            self.matrix = self.vectors
+        elif previous is not None and len(previous) <= capacity:
+            self.matrix = np.empty((capacity, self.dim), dtype=np.float32)
+            self.matrix[:len(previous)] = previous
+            self.matrix[len(previous):] = self.vectors[len(previous):]
+        else:
+            self.matrix = np.asarray(self.vectors, dtype=np.float32)
+        alive = np.zeros(capacity, dtype=bool)
+        n = min(len(self.alive), capacity)
+        alive[:n] = self.alive[:n]
+        self.alive = alive
+        self.capacity = capacity
+        self.mapped = self.vectors_name
+
+    # apply the log entries written since the last call, a torn last entry is left for later
+    def _replay(self):
+        if self.log_name is None:
+            return
+        try:
+            f = open(self.folder + self.log_name, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self.offset)
+            while True:
+                try:
+                    entry = pickle.load(f)
+                except Exception:
+                    break
+                self._apply(entry)
+                self.offset = f.tell()
+
+    def _apply(self, entry):
+        for position, row in entry.get('upsert', []):
+            if position >= self.capacity:
+                self._map()
+            while len(self.rows) <= position:
+                self.rows.append(None)
+            old = self.rows[position]
+            if old is not None and old['id'] != row['id']:
+                self.positions.pop(old['id'], None)
+            self.rows[position] = row
+            self.positions[row['id']] = position
+            self.alive[position] = True
+            if self.matrix is not self.vectors:
+                self.matrix[position] = self.vectors[position]
+        for position in entry.get('delete', []):
+            row = self.rows[position]
+            if row is not None:
+                self.positions.pop(row['id'], None)
+                self.rows[position] = None
+                self.alive[position] = False
+
+    # catch up with the writes of other processes
+    def _refresh(self):
+        try:
+            stat = os.stat(self.folder + 'rows.pkl')
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        if signature != self.signature:
+            self._load()
+            return
+        try:
+            if self.vectors_name is not None and self.dim is not None:
+                if os.path.getsize(self.folder + self.vectors_name) != self.capacity * np.dtype(self.dtype).itemsize * self.dim:
+                    self._map()
+            if self.log_name is not None and os.path.getsize(self.folder + self.log_name) != self.offset:
+                self._replay()
+        except FileNotFoundError:
+            #another process wrote a new snapshot since the check above
+            self._load()
+
+    # write the whole state as a new snapshot with an empty log, only with the folder lock
+    def _snapshot(self):
+        log_name = 'log-' + secrets.token_hex(6) + '.pkl'
+        open(self.folder + log_name, 'wb').close()
+        state = {'dtype': self.dtype, 'dim': self.dim, 'rows': self.rows, 'vectors': self.vectors_name, 'log': log_name}
+        with open(self.folder + 'rows.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.folder + 'rows.tmp', self.folder + 'rows.pkl')
+        stat = os.stat(self.folder + 'rows.pkl')
+        self.signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.log_name = log_name
+        self.offset = 0
+        #logs and vectors the snapshot no longer uses, files still open in another process are removed later
+        for name in os.listdir(self.folder):
+            if (name.startswith('log-') or name.startswith('vectors-')) and name not in (self.log_name, self.vectors_name):
+                try:
+                    os.remove(self.folder + name)
+                except OSError:
+                    pass
+
+    def _append(self, entry):
+        with open(self.folder + self.log_name, 'ab') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            self.offset = f.tell()
+        if self.offset > max(self.signature[2], 1 << 20):
+            self._snapshot()
+
+    # start writing with the folder lock held: catch up and drop a log entry torn by a process that stopped mid-write
+    def _begin(self):
+        self._refresh()
+        if self.log_name is None:
+            self._snapshot()
+        elif os.path.getsize(self.folder + self.log_name) > self.offset:
+            with open(self.folder + self.log_name, 'r+b') as f:
+                f.truncate(self.offset)
+
+    # make room for n more rows, the file grows in place by doubling
+    def _reserve(self, n):
+        needed = len(self.rows) + n
+        if needed <= self.capacity:
+            return
+        capacity = max(1024, self.capacity)
+        while capacity < needed:
+            capacity = capacity * 2
+        created = self.vectors_name is None
+        if created:
+            self.vectors_name = 'vectors-' + secrets.token_hex(6) + '.bin'
+        with open(self.folder + self.vectors_name, 'ab') as f:
+            f.truncate(capacity * np.dtype(self.dtype).itemsize * self.dim)
+        self._map()
+        if created:
+            #the snapshot has to name the file before the log refers to its rows
+            self._snapshot()
+
+    @staticmethod
+    def _normalize(embeddings):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def count(self):
+        with self.lock:
+            self._refresh()
+            return len(self.positions)
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        self.upsert(ids, embeddings, documents, metadatas)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+        matrix = self._normalize(embeddings)
+        with self.lock, self._file_lock():
+            self._begin()
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+            new = {}
+            for id_ in ids:
+                if id_ not in self.positions and id_ not in new:
+                    new[id_] = len(self.rows) + len(new)
+            self._reserve(len(new))
+            changed = []
+            for id_, vector, document, metadata in zip(ids, matrix, documents, metadatas):
+                position = self.positions.get(id_, new.get(id_))
+                self.vectors[position] = vector
+                changed.append((position, {'id': id_, 'document': document, 'metadata': metadata}))
+            #the vectors are on disk before the log entry that points to them
+            self.vectors.flush()
+            entry = {'upsert': changed}
+            self._apply(entry)
+            self._append(entry)
+
+    def delete(self, ids=None, where=None):
+        with self.lock, self._file_lock():
+            if ids is None and where is None:
+                return
+            self._begin()
+            selected = self._select(ids, where)
+            if not selected:
+                return
+            entry = {'delete': selected}
+            self._apply(entry)
+            self._append(entry)
+            if len(self.rows) - len(self.positions) > len(self.rows) // 4:
+                self._compact()
+
+    # drop the rows marked as deleted, the live rows are copied to a new vectors file so other processes can keep reading
+    # the old one until they reload
+    def _compact(self):
+        keep = [i for i, row in enumerate(self.rows) if row is not None]
+        capacity = 1024
+        while capacity < len(keep):
+            capacity = capacity * 2
+        vectors_name = 'vectors-' + secrets.token_hex(6) + '.bin'
+        with open(self.folder + vectors_name, 'wb') as f:
+            f.truncate(capacity * np.dtype(self.dtype).itemsize * self.dim)
+        vectors = np.memmap(self.folder + vectors_name, dtype=self.dtype, mode='r+', shape=(capacity, self.dim))
+        for start in range(0, len(keep), 8192):
+            chunk = keep[start:start + 8192]
+            vectors[start:start + len(chunk)] = self.vectors[chunk]
+        vectors.flush()
+        del vectors
+        self.rows = [self.rows[i] for i in keep]
+        self.positions = {row['id']: i for i, row in enumerate(self.rows)}
+        self.vectors_name = vectors_name
+        self.vectors = None
+        self.matrix = None
+        self.mapped = None
+        self.capacity = 0
+        self.alive = np.zeros(0, dtype=bool)
+        self._map()
+        self.alive[:len(self.rows)] = True
+        self._snapshot()
+
+    @staticmethod
+    def _match(metadata, where):
+        metadata = metadata or {}
+        for key, condition in where.items():
+            if key == '$and':
+                if not all(MatrixTable._match(metadata, c) for c in condition):
+                    return False
+            elif key == '$or':
+                if not any(MatrixTable._match(metadata, c) for c in condition):
+                    return False
+            else:
+                value = metadata.get(key)
+                if not isinstance(condition, dict):
+                    condition = {'$eq': condition}
+                for operator, target in condition.items():
+                    if operator == '$eq' and value != target:
+                        return False
+                    if operator == '$ne' and value == target:
+                        return False
+                    if operator == '$in' and value not in target:
+                        return False
+                    if operator == '$nin' and value in target:
+                        return False
+                    if operator in ('$gt', '$gte', '$lt', '$lte'):
+                        if value is None:
+                            return False
+                        if operator == '$gt' and not value > target:
+                            return False
+                        if operator == '$gte' and not value >= target:
+                            return False
+                        if operator == '$lt' and not value < target:
+                            return False
+                        if operator == '$lte' and not value <= target:
+                            return False
+        return True
+
+    # positions of the live rows with the given ids that pass the filter
+    def _select(self, ids=None, where=None):
+        if ids is not None:
+            positions = [self.positions[id_] for id_ in ids if id_ in self.positions]
+        else:
+            positions = [i for i, row in enumerate(self.rows) if row is not None]
+        if where:
+            positions = [i for i in positions if self._match(self.rows[i]['metadata'], where)]
+        return positions
+
+    def get(self, ids=None, where=None, include=('documents', 'metadatas')):
+        with self.lock:
+            self._refresh()
+            positions = self._select(ids, where)
+            result = {'ids': [self.rows[i]['id'] for i in positions]}
+            if 'documents' in include:
+                result['documents'] = [self.rows[i]['document'] for i in positions]
+            if 'metadatas' in include:
+                result['metadatas'] = [dict(self.rows[i]['metadata'] or {}) for i in positions]
+            if 'embeddings' in include:
+                result['embeddings'] = [self.matrix[i].tolist() for i in positions]
+            return result
+
+    # exact top n_results of every query vector by cosine similarity
+    def query(self, query_embeddings, n_results=10, where=None, include=('documents', 'metadatas', 'distances')):
+        queries = self._normalize(query_embeddings)
+        result = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        with self.lock:
+            self._refresh()
+            if not self.positions:
+                for q in queries:
+                    for key in result:
+                        result[key].append([])
+                return result
+            size = len(self.rows)
+            scores = self.matrix[:size] @ queries.T
+            if where:
+                allowed = np.zeros(size, dtype=bool)
+                allowed[self._select(None, where)] = True
+            else:
+                allowed = self.alive[:size]
+            scores[~allowed] = -np.inf
+            n = min(n_results, int(allowed.sum()))
+            for column in range(scores.shape[1]):
+                similarity = scores[:, column]
+                if n == 0:
+                    top = []
+                else:
+                    top = np.argpartition(-similarity, n - 1)[:n]
+                    top = top[np.argsort(-similarity[top])]
+                result['ids'].append([self.rows[i]['id'] for i in top])
+                result['documents'].append([self.rows[i]['document'] for i in top])
+                result['metadatas'].append([dict(self.rows[i]['metadata'] or {}) for i in top])
+                result['distances'].append([float(1 - similarity[i]) for i in top])
+        return result
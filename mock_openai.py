@@ -0,0 +1,293 @@
+"""
+    A local stand-in for the OpenAI chat completions and embeddings endpoints, used to benchmark the app without using the
+    real API or the network.
+    1. Embeddings are deterministic: every word of the text is hashed into the vector, so texts sharing words are close.
+    2. Chat completions return canned JSON shaped like the schemas the prompts of RAG, Assist, Heads, Process and History
+       ask for (answer, phrases, name, result, tool, metadata, summary ...). Streaming requests are answered as a stream.
+    3. Latency of every response is drawn from a configurable distribution: fixed:S, uniform:A,B or lognormal:MU,SIGMA.
+    4. In record mode requests are forwarded to the real API and the responses are saved; in replay mode saved responses are
+       served and the canned answers are only used for requests that were never recorded.
+
+    Usage:
+        python mock_openai.py serve --port 8090 --chat-latency lognormal:0.5,0.4 --embedd-latency fixed:0.05
+        python mock_openai.py serve --mode record --upstream https://api.openai.com/v1 --key sk-... --tape ../mock/tape.jsonl
+        python mock_openai.py serve --mode replay --tape ../mock/tape.jsonl
+        python mock_openai.py load --url http://localhost:8080/play --token JWT --data '{"prompt":"bail requirements"}' -n 50 -c 5
+
+    Point the app at the server by setting 'base_url' in ../keys.json (or OPENAI_BASE_URL) to http://localhost:8090/v1.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+import requests
+from flask import Flask, request, Response, jsonify
+
+DIMENSIONS = 1536
+
+class MockOpenAI:
+    def __init__(self, chat_latency='fixed:0', embedd_latency='fixed:0', token_delay=0.0, mode='mock', tape=None, upstream=None, key=None):
+        self.chat_latency = self.distribution(chat_latency)
+        self.embedd_latency = self.distribution(embedd_latency)
+        self.token_delay = token_delay
+        self.mode = mode
+        self.tape_path = tape
+        self.upstream = upstream
+        self.key = key
+        self.lock = threading.Lock()
+        self.tape = {}
+        if tape and mode == 'replay':
+            self.load_tape()
+        if tape and mode == 'record':
+            os.makedirs(os.path.dirname(tape) or '.', exist_ok=True)
+
+    # parse a latency distribution like fixed:0.5, uniform:0.2,1.5 or lognormal:0.5,0.4
+    @staticmethod
+    def distribution(spec):
+        kind, _, args = spec.partition(':')
+        values = [float(v) for v in args.split(',') if v]
+        if kind == 'fixed':
+            return lambda: values[0] if values else 0.0
+        if kind == 'uniform':
+            return lambda: random.uniform(values[0], values[1])
+        if kind == 'lognormal':
+            return lambda: random.lognormvariate(values[0], values[1])
+        raise ValueError('Unknown latency distribution: ' + spec)
+
+    #---------------------------------------record and replay
+
+    @staticmethod
+    def request_key(body):
+        fields = {k: v for k, v in body.items() if k not in ('stream', 'stream_options', 'user')}
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_tape(self):
+        try:
+            with open(self.tape_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.tape[record['key']] = record['response']
+        except FileNotFoundError:
+            print(f"Error: File not found at {self.tape_path}")
+
+    def record(self, key, response):
+        with self.lock:
+            with open(self.tape_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'key': key, 'response': response}) + '\n')
+
+    def forward(self, path, body):
+        fields = {k: v for k, v in body.items() if k not in ('stream', 'stream_options')}
+        res = requests.post(self.upstream.rstrip('/') + path, json=fields, headers={'Authorization': 'Bearer ' + self.key}, timeout=600)
+        res.raise_for_status()
+        return res.json()
+
+    def respond(self, path, body, canned):
+        key = self.request_key(body)
+        if self.mode == 'replay' and key in self.tape:
+            return self.tape[key]
+        if self.mode == 'record':
+            response = self.forward(path, body)
+            self.record(key, response)
+            return response
+        return canned(body)
+
+    #---------------------------------------embeddings
+
+    # hash every word of the text into the vector so that texts sharing words get similar vectors
+    @staticmethod
+    def embedd(text):
+        vector = [0.0] * DIMENSIONS
+        words = re.findall(r'\w+', text.lower())
+        if not words:
+            words = [text]
+        for word in words:
+            digest = hashlib.md5(word.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % DIMENSIONS
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def canned_embeddings(self, body):
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        return {'object': 'list', 'model': body.get('model'),
+                'data': [{'object': 'embedding', 'index': i, 'embedding': self.embedd(text)} for i, text in enumerate(inputs)],
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}}
+
+    #---------------------------------------chat completions
+
+    @staticmethod
+    def text_of(content):
+        if isinstance(content, list):
+            return ' '.join(part.get('text', '') for part in content)
+        return str(content)
+
+    @staticmethod
+    def tables_in(text):
+        names = re.findall(r"name='?([\w-]+)", text)
+        if not names:
+            match = re.search(r'Tables available: \[([^\]]*)\]', text)
+            if match:
+                names = [n.strip(" '\"") for n in match.group(1).split(',') if n.strip(" '\"")]
+        return names or ['mock']
+
+    # a canned answer shaped like what the system prompt asks for
+    def canned_answer(self, body):
+        system = self.text_of(body['messages'][0]['content']) if body['messages'] else ''
+        prompt = self.text_of(body['messages'][-1]['content']) if body['messages'] else ''
+        words = re.findall(r'\w+', prompt)
+        topic = ' '.join(words[-8:]) or 'the question'
+        if 'provide a name for the new chat' in system:
+            return {'name': ' '.join(words[:6]) or 'New chat'}
+        if 'act as a validator' in system:
+            return {'result': 'complete', 'message': ''}
+        if 'decide on what tool' in system:
+            return {'tool': 'Legal Research'}
+        if 'names of the vector database tables' in system:
+            table = self.tables_in(system)[0]
+            return {'result': 'complete', 'data': [{'phrase': topic, 'table': table}]}
+        if 'create search phrases' in system:
+            match = re.search(r'Number of phrases needed: (\d+)', prompt)
+            n = int(match.group(1)) if match else 1
+            tables = self.tables_in(prompt)
+            return {'phrases': [{'phrase': topic + ' ' + str(i + 1), 'table': tables[i % len(tables)]} for i in range(n)]}
+        if 'analyze legislations and extract metadata' in system:
+            return {'metadata': {'juris': 'Zimbabwe', 'citation': 'Mock Act, Chapter 0:00'}}
+        if 'analyze court rulings' in system:
+            return {'name': 'Mock v State', 'citation': 'Mock v State HH ' + str(len(prompt) % 500) + '/24', 'court': 'High Court of Zimbabwe',
+                    'date': '1 January 2024', 'case_number': 'HC 1/24', 'judges': ['Mock J'], 'summary': ' '.join(words[:200]),
+                    'keywords': words[:10], 'jurisdiction': 'Zimbabwe', 'parties': [{'name': 'Mock', 'role': 'applicant'}],
+                    'case_law': [{'citation': 'Other v Mock SC 1/20', 'desc': ' '.join(words[:40]), 'result': 'referred'}],
+                    'legislation': [{'citation': 'Mock Act, Section 1', 'legislation': 'Mock Act', 'section': 'Section 1', 'desc': ' '.join(words[40:80]), 'result': 'referred'}],
+                    'set_precedent': []}
+        if "{'summary'" in system:
+            return {'summary': ' '.join(words[:300])}
+        return {'answer': [{'type': 'header', 'data': 'Answer'}, {'type': 'paragraph', 'data': 'Mock answer about ' + topic + '.'}]}
+
+    def canned_chat(self, body):
+        answer = self.canned_answer(body)
+        if body.get('response_format', {}).get('type') == 'json_object':
+            content = json.dumps(answer)
+        else:
+            content = 'Mock research answer: ' + json.dumps(answer)
+        prompt_tokens = sum(len(self.text_of(m['content'])) // 4 + 1 for m in body['messages'])
+        completion_tokens = len(content) // 4 + 1
+        return {'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}}
+
+    # serve a completion as a stream of chunks
+    def stream(self, response):
+        content = response['choices'][0]['message']['content']
+        base = {'id': response.get('id'), 'object': 'chat.completion.chunk', 'created': response.get('created'), 'model': response.get('model')}
+        def generate():
+            for i in range(0, len(content), 16):
+                chunk = dict(base, choices=[{'index': 0, 'delta': {'content': content[i:i+16]}, 'finish_reason': None}])
+                yield 'data: ' + json.dumps(chunk) + '\n\n'
+                if self.token_delay:
+                    time.sleep(self.token_delay)
+            yield 'data: ' + json.dumps(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])) + '\n\n'
+            yield 'data: ' + json.dumps(dict(base, choices=[], usage=response.get('usage'))) + '\n\n'
+            yield 'data: [DONE]\n\n'
+        return Response(generate(), mimetype='text/event-stream')
+
+    def app(self):
+        app = Flask(__name__)
+
+        @app.route('/v1/embeddings', methods=['POST'])
+        def embeddings():
+            body = request.get_json()
+            time.sleep(self.embedd_latency())
+            return jsonify(self.respond('/embeddings', body, self.canned_embeddings))
+
+        @app.route('/v1/chat/completions', methods=['POST'])
+        def chat_completions():
+            body = request.get_json()
+            time.sleep(self.chat_latency())
+            response = self.respond('/chat/completions', body, self.canned_chat)
+            if body.get('stream'):
+                return self.stream(response)
+            return jsonify(response)
+
+        return app
+
+
+#---------------------------------------load testing
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+# fire n requests at a url with c of them in flight and report the latency distribution
+def load(url, token, data, n, c, method='POST'):
+    headers = {'Authorization': 'Bearer ' + token} if token else {}
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(n))
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                res = session.request(method, url, json=data, headers=headers, timeout=600)
+                res.raise_for_status()
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(c)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'requests': n, 'errors': len(errors), 'seconds': round(elapsed, 3), 'rps': round(n / elapsed, 2) if elapsed else 0.0,
+            'p50': round(percentile(latencies, 50), 3), 'p95': round(percentile(latencies, 95), 3), 'p99': round(percentile(latencies, 99), 3)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OpenAI stand-in and load driver')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--port', type=int, default=8090)
+    serve.add_argument('--chat-latency', default='fixed:0')
+    serve.add_argument('--embedd-latency', default='fixed:0')
+    serve.add_argument('--token-delay', type=float, default=0.0)
+    serve.add_argument('--mode', choices=['mock', 'record', 'replay'], default='mock')
+    serve.add_argument('--tape', default='../mock/tape.jsonl')
+    serve.add_argument('--upstream', default='https://api.openai.com/v1')
+    serve.add_argument('--key')
+    bench = commands.add_parser('load')
+    bench.add_argument('--url', required=True)
+    bench.add_argument('--token')
+    bench.add_argument('--data', default='{}')
+    bench.add_argument('--method', default='POST')
+    bench.add_argument('-n', type=int, default=20)
+    bench.add_argument('-c', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.mode == 'record' and not args.key:
+            sys.exit('--key is required in record mode')
+        mock = MockOpenAI(args.chat_latency, args.embedd_latency, args.token_delay, args.mode, args.tape, args.upstream, args.key)
+        mock.app().run(host='0.0.0.0', port=args.port, threaded=True)
+    else:
+        print(json.dumps(load(args.url, args.token, json.loads(args.data), args.n, args.c, args.method), indent=4))
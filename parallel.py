@@ -0,0 +1,66 @@
+"""
+    Class Parallel for running blocking work (OpenAI calls, vector searches, document parsing) concurrently on a bounded pool
+    of threads.
+    1. map: calls a function on every item and returns the results in the order of the items. An item that raises or does not
+       finish in time gets the default instead, so one slow or failing item never loses the results of the others.
+       With a pool name the items run on a pool of that name shared by the whole process (created with workers threads by
+       its first use), so work started from many requests at once stays under one cap. Timed out items of a shared pool
+       keep their thread until they finish, which still counts against the cap.
+
+    The request context used by Tracing is carried into the worker threads.
+"""
+
+import math
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from tracing import Tracing
+
+class Parallel:
+    pools = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def shared(name, workers):
+        with Parallel.lock:
+            if name not in Parallel.pools:
+                Parallel.pools[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+            return Parallel.pools[name]
+
+    # timeout is the time allowed per item; items queued behind a full pool get one more timeout per wave
+    @staticmethod
+    def map(func, items, workers=8, timeout=None, default=None, pool=None):
+        items = list(items)
+        if not items:
+            return []
+        shared = pool is not None
+        if shared:
+            pool = Parallel.shared(pool, workers)
+        workers = max(1, min(workers, len(items)))
+        if not shared:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        futures = []
+        try:
+            futures = [pool.submit(Tracing.propagate(func), item) for item in items]
+            limit = None if timeout is None else timeout * math.ceil(len(items) / workers)
+            wait(futures, timeout=limit)
+            results = []
+            for item, future in zip(items, futures):
+                if not future.done():
+                    future.cancel()
+                    print(f"Timed out after {timeout}s: {func.__name__}({str(item)[:100]})")
+                    results.append(default)
+                elif future.exception() is not None:
+                    error = future.exception()
+                    print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+                    results.append(default)
+                else:
+                    results.append(future.result())
+            return results
+        finally:
+            #do not wait for timed out work, its result is discarded
+            if shared:
+                for future in futures:
+                    future.cancel()
+            else:
+                pool.shutdown(wait=False, cancel_futures=True)
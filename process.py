@@ -1,12 +1,18 @@
+import re
 import json
 import traceback
+from datetime import datetime
 from gpt import GPT
 from euclid import Euclid
+from cache import EmbeddingCache
 from langchain.text_splitter import TokenTextSplitter
 
 class Process:
     def __init__(self):
         self.gpt = GPT()
+        self.cache = EmbeddingCache()
+        #records of a document written to the vector database per batch
+        self.insert_batch = 1000
         self.court = '''
         You are part of a legal citator system in Zimbabwe which is being used to analyze court rulings and format them in an appropriate way.
         The following is from a document of a legal ruling made by a court. You are required to analyze the ruling like you are a professional lawyer.
@@ -43,43 +49,119 @@ class Process:
         'Electoral Act, Chapter 24:03', 'Elections Regulations of 2019, Electoral Act' etc.
         '''
 
-    # Method for generating an analysis of court rulings
-    def court_proc(self,table, table_id, file_id, filename, document):
+    # Analysis of a court ruling by the AI
+    def court_content(self, document):
         text = ''
         for t in document:
             text = text + t['text']
         messages = [{'role': 'system', 'content': [{'type': 'text', 'text': self.court}]}]
         messages.append({'role': 'user', 'content': [{'type': 'text', 'text': text}]})
+        raw_json = self.gpt.json_gpt(messages)
+        return json.loads(raw_json)
+
+    # The vector records of an analysed ruling: the summary, case law, legislation and new precedents
+    def court_records(self, table_id, file_id, filename, content):
+        meta={'citation':content['citation'],'table_id':table_id,'file_id':file_id,'filename':filename}
+        #court and date are stored for filtered searches, the date as yyyymmdd so it can be compared
+        if content.get('court'):
+            meta['court']=str(content['court'])
+        date=self.date_number(content.get('date'))
+        if date:
+            meta['date']=date
+        texts=[content['citation']+' : '+ content['summary']]
+        if len(content['case_law'])>0:
+            case_l=''
+            for c in content['case_law']:
+                case_l=case_l +'; '+ c['desc']
+            texts.append(case_l)
+        if len(content['legislation'])>0:
+            legi=''
+            for c in content['legislation']:
+                legi=legi +'; '+ c['citation'] + ': '+c['desc']
+            texts.append(legi)
+        if len(content['set_precedent'])>0:
+            case_l=''
+            for c in content['set_precedent']:
+                case_l=case_l +'; '+ c['desc']
+            texts.append(case_l)
+        return [{'document':text,'meta':meta,'text':text} for text in texts]
+
+    # A date written by the AI (e.g. '3rd March 2023', '2023-03-03', '03/03/2023') as the number yyyymmdd, None if unknown
+    @staticmethod
+    def date_number(text):
+        if not text:
+            return None
+        text=re.sub(r'(\d+)(st|nd|rd|th)\b', r'\1', str(text)).replace(',', ' ').strip()
+        text=' '.join(text.split())
+        for fmt in ('%d %B %Y', '%d %b %Y', '%B %d %Y', '%b %d %Y', '%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%B %Y', '%Y'):
+            try:
+                return int(datetime.strptime(text, fmt).strftime('%Y%m%d'))
+            except ValueError:
+                pass
+        return None
+
+    # Embedd the text of many records at once, unchanged texts come from the cache
+    def embedd(self, records):
+        embedds=self.gpt.embedd_texts([record['text'] for record in records], self.cache)
+        for record, embedd in zip(records, embedds):
+            record['embedding']=embedd
+        return records
+
+    # Ids of records: the file, the section and chunk (or the place of the record among the records of its file) and a hash
+    # of its content, so the ids of a file do not depend on the other files stored with it
+    def record_ids(self, records):
+        ids=[]
+        places={}
+        for record in records:
+            meta=record['meta']
+            file_id=meta.get('file_id','')
+            place=places.get(file_id,0)
+            places[file_id]=place+1
+            index=str(meta['section_id'])+'.'+str(meta['chunk']) if 'section_id' in meta else place
+            ids.append(Euclid.record_id(file_id, index, {'document':record['document'],'text':record['text'],'meta':meta}))
+        return ids
+
+    # Add embedded records to a table in batches, records that are already stored are overwritten
+    # ids must be given when records are not all the records of their files (see record_ids)
+    def store(self, table, records, batch=None, ids=None):
+        if not records:
+            return
+        vector=Euclid()
+        add=vector.add_many(table,[record['document'] for record in records],[record['meta'] for record in records],
+                            [record['embedding'] for record in records],ids or self.record_ids(records),batch or self.insert_batch)
+        if add['result']!='success':
+            raise Exception(add['result'])
+
+    # Make the records of a file in a table the given ones: only new or changed records are embedded and written and the
+    # records that are no longer there are deleted
+    def sync(self, table, file_id, records, batch=None):
+        vector=Euclid()
+        ids=self.record_ids(records)
+        existing=set(vector.ids(table,'file_id',file_id))
+        fresh=[(record, id_) for record, id_ in zip(records, ids) if id_ not in existing]
+        self.store(table, self.embedd([record for record, id_ in fresh]), batch, [id_ for record, id_ in fresh])
+        stale=list(existing-set(ids))
+        if stale and vector.delete_ids(table, stale)!='success':
+            raise Exception('error deleting stale records')
+        return {'written':len(fresh),'deleted':len(stale),'kept':len(ids)-len(fresh)}
+
+    # Analyse a ruling again and replace its records, records that did not change are kept
+    def court_update(self, table, table_id, file_id, filename, document):
         try:
-            raw_json = self.gpt.json_gpt(messages)
-            content = json.loads(raw_json)
+            content = self.court_content(document)
+            self.sync(table, file_id, self.court_records(table_id, file_id, filename, content))
+            return {'result': 'success', 'content': content}
+        except Exception as e:
+            print(traceback.format_exc())
+            return {'result': str(e), 'content': {}}
+
+    # Method for generating an analysis of court rulings
+    def court_proc(self,table, table_id, file_id, filename, document):
+        try:
+            content = self.court_content(document)
             #embedd rulings
-            vector=Euclid()
-            meta={'citation':content['citation'],'table_id':table_id,'file_id':file_id,'filename':filename}
-            cite=content['citation']+' : '+ content['summary']
-            cite_embeds=self.gpt.embedd_text(cite)
-            vector.add(table,cite,meta,cite_embeds)
-            if len(content['case_law'])>0:
-                case_l=''
-                for c in content['case_law']:
-                    case_l=case_l +'; '+ c['desc']
-                #append
-                case_embedds=self.gpt.embedd_text(case_l)
-                vector.add(table,case_l,meta,case_embedds)
-            if len(content['legislation'])>0:
-                legi=''
-                for c in content['legislation']:
-                    legi=legi +'; '+ c['citation'] + ': '+c['desc']
-                #append
-                legi_embedds=self.gpt.embedd_text(legi)
-                vector.add(table,legi,meta,legi_embedds)
-            if len(content['set_precedent'])>0:
-                case_l=''
-                for c in content['set_precedent']:
-                    case_l=case_l +'; '+ c['desc']
-                #append
-                case_embedds=self.gpt.embedd_text(case_l)
-                vector.add(table,case_l,meta,case_embedds)
+            records = self.embedd(self.court_records(table_id, file_id, filename, content))
+            self.store(table, records)
             return {'result': 'success', 'content': content}
         except Exception as e:
             print(traceback.format_exc())
@@ -134,27 +216,43 @@ class Process:
             print(traceback.format_exc())
             return {}
 
+    # The 500 token chunks of every section, each chunk is stored on its own with the number of its section, its number
+    # in the section and where it starts in the section text. The whole section is read from the processed file when needed.
+    def section_records(self, meta, sections):
+        splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=150)
+        records=[]
+        for section_id, sec_text in enumerate(sections):
+            offset=0
+            for n, chunk in enumerate(splitter.split_text(sec_text)):
+                found=sec_text.find(chunk, offset)
+                offset=found if found>=0 else offset
+                chunk_meta=dict(meta, section_id=section_id, chunk=n, offset=offset)
+                records.append({'document':chunk,'meta':chunk_meta,'text':chunk})
+        return records
+
+    # The vector records of a sectioned legislation, cite puts the citation in front of every section
+    def legislation_records(self, table_id, file_id, filename, legi, cite=True):
+        meta={'citation':legi['citation'],'table_id':table_id,'file_id':file_id,'filename':filename}
+        new_sections=[]
+        for section in legi['sections']:
+            section_title=section['title']
+            temp=[]
+            for line in section['content']:
+                temp.append(line['text'])
+            new_sections.append({'title':section_title,'lines':temp})
+        #end for
+        if cite:
+            sections=[legi['citation']+' : '+' '.join(section['lines']) for section in new_sections]
+        else:
+            sections=[' '.join(section['lines']) for section in new_sections]
+        return self.section_records(meta, sections)
+
     # Method to process sections of a legislation
     def legislation_html(self, table, table_id, file_id, filename, document):
         try:
             legi=self.sectioning_html(document)
-            meta={'citation':legi['citation'],'table_id':table_id,'file_id':file_id,'filename':filename}
-            vector=Euclid()
-            new_sections=[]
-            for section in legi['sections']:
-                section_title=section['title']
-                temp=[]
-                for line in section['content']:
-                    temp.append(line['text'])
-                new_sections.append({'title':section_title,'lines':temp})
-            #end for
-            for section in new_sections:
-                sec_text=' '.join(section['lines'])
-                splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=150)
-                chunks=splitter.split_text(sec_text)
-                for chunk in chunks:
-                    sec_embedd=self.gpt.embedd_text(chunk)
-                    vector.add(table,sec_text,meta,sec_embedd)
+            records=self.embedd(self.legislation_records(table_id, file_id, filename, legi, False))
+            self.store(table, records)
 
             #return the document
             return {'result': 'success', 'content': legi}
@@ -167,24 +265,8 @@ class Process:
     def legislation(self, table, table_id, file_id, filename, document):
         try:
             legi=self.sectioning(document)
-            meta={'citation':legi['citation'],'table_id':table_id,'file_id':file_id,'filename':filename}
-            vector=Euclid()
-            new_sections=[]
-            for section in legi['sections']:
-                section_title=section['title']
-                temp=[]
-                for line in section['content']:
-                    temp.append(line['text'])
-                new_sections.append({'title':section_title,'lines':temp})
-            #end for
-            for section in new_sections:
-                sec_text=' '.join(section['lines'])
-                sec_text=legi['citation']+' : '+sec_text
-                splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=150)
-                chunks=splitter.split_text(sec_text)
-                for chunk in chunks:
-                    sec_embedd=self.gpt.embedd_text(chunk)
-                    vector.add(table,sec_text,meta,sec_embedd)
+            records=self.embedd(self.legislation_records(table_id, file_id, filename, legi))
+            self.store(table, records)
 
             #return the document
             return {'result': 'success', 'content': legi}
@@ -193,19 +275,12 @@ class Process:
             print(traceback.format_exc())
             return {'result': str(e), 'content': {}}
 
+    # Replace the records of an edited legislation, only the chunks of changed sections are written
     def update_legi(self, table, table_id, file_id, filename, document):
-        #document was deleted
         try:
-            #end for loop
             meta={'citation':document['citation'],'table_id':table_id,'file_id':file_id,'filename':filename}
-            vector=Euclid()
-            for section in document['sections']:
-                sec_text=' '.join(section['lines'])
-                splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=150)
-                chunks=splitter.split_text(sec_text)
-                for chunk in chunks:
-                    sec_embedd=self.gpt.embedd_text(chunk)
-                    vector.add(table,sec_text,meta,sec_embedd)
+            sections=[' '.join(section['lines']) for section in document['sections']]
+            self.sync(table, file_id, self.section_records(meta, sections))
             return 'success'
         
         except Exception as e:
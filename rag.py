@@ -1,13 +1,32 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from gpt import GPT
-from collector import Collector
-from langchain.text_splitter import TokenTextSplitter
+from documents import Documents
+from history import History
+from cache import AnswerCache
+from tracing import Tracing
+from research import Research
 
 class RAG:
     def __init__(self, euclid):
         self.euclid = euclid
         self.gpt = GPT()
+        self.history = History()
+        #token budget of the chat history replayed at every stage
+        self.budgets = {'validate':2000, 'phraser':2000, 'answer':6000, 'multi':6000}
+        #how Euclid ranks records: 'vector', 'lexical' or 'hybrid' (cosine and BM25 fused)
+        self.search_mode = 'hybrid'
+        #a legislation section is sent whole when at least expand_hits of its chunks are found, otherwise only its chunks
+        self.expand_hits = 2
+        #single_step reuses the answer of a near identical question when the chat has at most answer_cache_turns turns,
+        #with earlier turns the answer is only reused in a chat with the same (compacted) history
+        self.answer_cache = True
+        self.answer_cache_turns = 0
+        #start the phrases (and the search when speculate_retrieval is set) while validation runs, the work is
+        #discarded when the prompt turns out to be incomplete
+        self.speculate = True
+        self.speculate_retrieval = True
         self.items = []
         self.system = """
         You are a legal research assistant and you are required to assist the user in what they ask and return your answer in json format.
@@ -73,6 +92,7 @@ class RAG:
         and citations are very mandatory. Cite as much as possible without hallucinations and also cite precedent/case law used if the
         content is a court ruling and cite sections/subsections/paragraphs ect. if the provided document is alegislation or contract.
         """
+        self.reader = Research(self.gpt, self.researcher, 125000, 15000)
         self.namer="""
         You are part of an AI-powered legal research tool, provide a name for the new chat which a user created on the tool. The name
         should be short (not more than 7 words) and should be based on the user's question. Return a json format response with structure
@@ -116,28 +136,26 @@ class RAG:
     def naming(self, prompt):
         messages = [{"role": "system", "content": self.namer}]
         messages.append({"role": "user", "content": prompt})
-        answ = self.gpt.json_gpt(messages, 20)
+        answ = self.gpt.json_gpt(messages, 20, cached=True)
         answer=json.loads(answ)
 
         return answer['name']
 
+    @Tracing.traced('rag.validate')
     def validate(self, prompt, history):
         messages = [{"role": "system", "content": self.validator}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, self.budgets['validate']))
         messages.append({"role": "user", "content": prompt})
-        answ = self.gpt.json_gpt(messages, 1000)
+        answ = self.gpt.json_gpt(messages, 1000, cached=True)
         answer=json.loads(answ)
         return answer
 
+    @Tracing.traced('rag.phraser')
     def phraser(self, prompt, history, tables, scope):
         messages = [{"role": "system", "content": self.phrases}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, self.budgets['phraser']))
         messages.append({"role": "user", "content": 'Tables available: '+ tables +', Number of phrases needed: ' +str(scope)+ '. User question: '+ prompt})
-        answ = self.gpt.json_gpt(messages, 4060)
+        answ = self.gpt.json_gpt(messages, 4060, cached=True)
         answer=json.loads(answ)
         return answer['phrases']
 
@@ -155,30 +173,81 @@ class RAG:
         sources=[{'citation': citation, 'table': table, 'table_id': table_id, 'file_id': file_id, 'filename': filename, 'document':document} for citation, table, table_id, file_id, filename, document in unique_docs]
         return sources
 
-    def single_step(self, prompt, history,k=3, scope=1):
-        #check if chat provides full context
-        check=self.validate(prompt, history)
-        if check['result'] == 'incomplete':
-            answer={'answer':[{'type': 'paragraph', 'data': check['message']}]}
-            ans=json.dumps(answer)
-            return ans,[]
-        #first generate phrases
+    # generate search phrases and retrieve the documents for them
+    @Tracing.traced('rag.retrieve')
+    def retrieve(self, prompt, history, k, scope):
         phrases=self.phraser(prompt, history, str(self.euclid.tables()), scope)
+        return phrases, self.search(phrases, k)
+
+    def search(self, phrases, k):
         raw_sources=[]
-        for phrase in phrases:
-            #search from phrases
-            raw_sources.extend(self.euclid.search(phrase['table'], phrase['phrase'], k))
+        #search all phrases at once
+        for results in self.euclid.search_phrases(phrases, k, mode=self.search_mode):
+            raw_sources.extend(results)
+        return self.load_unique_docu(self.collapse(raw_sources))
 
-        #RAG for answer
-        sources=self.load_unique_docu(raw_sources)
+    # merge the hits on chunks of the same section, records without a section are only deduplicated
+    def collapse(self, results):
+        groups={}
+        for item in results:
+            if 'section_id' in item:
+                key=(item['table'], item['file_id'], item['section_id'])
+            else:
+                key=(item['table'], item['file_id'], item['document'])
+            groups.setdefault(key, []).append(item)
+        collapsed=[]
+        for items in groups.values():
+            item=dict(max(items, key=lambda i: i.get('distance') or 0))
+            if 'section_id' in item:
+                chunks={}
+                for i in items:
+                    chunks[i['chunk']]=i['document']
+                section=None
+                if len(chunks) >= self.expand_hits:
+                    section=Documents.section(item['table'], item['table_id'], item['file_id'], item['filename'], item['section_id'])
+                item['document']=section or '\n'.join(chunks[n] for n in sorted(chunks))
+            collapsed.append(item)
+        return collapsed
+
+    # validate the prompt, returns the check and a function giving the phrases and sources when the prompt is complete.
+    # In speculative mode the phrases (and the search) run at the same time as the validation
+    def checked_retrieve(self, prompt, history, k, scope):
+        if not self.speculate:
+            check=self.validate(prompt, history)
+            return check, lambda: self.retrieve(prompt, history, k, scope)
+        if self.speculate_retrieval:
+            work=lambda: self.retrieve(prompt, history, k, scope)
+        else:
+            work=lambda: self.phraser(prompt, history, str(self.euclid.tables()), scope)
+        pool=ThreadPoolExecutor(max_workers=1)
+        future=pool.submit(Tracing.propagate(work))
+        pool.shutdown(wait=False)
+        try:
+            check=self.validate(prompt, history)
+        except Exception:
+            future.cancel()
+            raise
+        if check['result'] == 'incomplete':
+            future.cancel()
+            Tracing.count('speculative_total', outcome='wasted', stage='retrieve' if self.speculate_retrieval else 'phraser')
+            return check, None
+        Tracing.count('speculative_total', outcome='used', stage='retrieve' if self.speculate_retrieval else 'phraser')
+        if self.speculate_retrieval:
+            return check, future.result
+        def searched():
+            phrases=future.result()
+            return phrases, self.search(phrases, k)
+        return check, searched
+
+    def answer_messages(self, prompt, history, sources):
         temp=[{'citation':item['citation'],'content':item['document']} for item in sources]
         context = "Data: " + str(temp) + "\n Prompt:" + prompt
         messages = [{"role": "system", "content": self.system}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, self.budgets['answer']))
         messages.append({"role": "user", "content": context})
-        answ = self.gpt.json_gpt(messages, 15000)
+        return messages
+
+    def finish_answer(self, answ, phrases, sources):
         answer=json.loads(answ)
         answer['phrases']=phrases
         sources=self.load_unique(sources)
@@ -186,56 +255,107 @@ class RAG:
         answer1=json.dumps(answer)
         return answer1, sources
 
+    # the stored answer of a question asked before, with the key to store the new answer under on a miss
+    def cached_answer(self, prompt, history, k, scope):
+        if not self.answer_cache or len(history) > self.answer_cache_turns:
+            return None, None
+        with Tracing.span('rag.answer_cache') as span:
+            try:
+                cache=AnswerCache.shared(GPT.config.get('answer_cache'))
+                #not through the EmbeddingCache, one-off prompts would push out the vectors of document chunks
+                vector=self.gpt.embedd_texts([prompt])[0]
+                key=(cache, vector, AnswerCache.scope(self.euclid.tables(), k, scope, self.search_mode, history))
+            except Exception as e:
+                print("Answer cache error: " + str(e))
+                return None, None
+            cached=cache.get(key[1], key[2])
+            span['hit']=cached is not None
+        Tracing.count('answer_cache_total', outcome='hit' if cached else 'miss')
+        return cached, key
+
+    def store_answer(self, key, prompt, answer, sources):
+        if key:
+            cache, vector, scope=key
+            cache.put(prompt, vector, scope, answer, sources)
+
+    @Tracing.traced('rag.single_step')
+    def single_step(self, prompt, history,k=3, scope=1):
+        cached, key=self.cached_answer(prompt, history, k, scope)
+        if cached:
+            return cached['answer'], cached['sources']
+        #check if chat provides full context
+        check, retrieval=self.checked_retrieve(prompt, history, k, scope)
+        if check['result'] == 'incomplete':
+            answer={'answer':[{'type': 'paragraph', 'data': check['message']}]}
+            ans=json.dumps(answer)
+            return ans,[]
+        #first generate phrases
+        phrases, sources=retrieval()
+        #RAG for answer
+        messages=self.answer_messages(prompt, history, sources)
+        answ = self.gpt.json_gpt(messages, 15000)
+        answer, sources=self.finish_answer(answ, phrases, sources)
+        self.store_answer(key, prompt, answer, sources)
+        return answer, sources
+
+    # same as single_step but yields events as the pipeline runs: stage changes, the answer tokens as they are generated
+    # and finally a done event carrying the answer and the sources
+    def single_step_stream(self, prompt, history, k=3, scope=1):
+        cached, key=self.cached_answer(prompt, history, k, scope)
+        if cached:
+            yield {'event':'done','answer':cached['answer'],'sources':cached['sources']}
+            return
+        yield {'event':'stage','data':'validating'}
+        check, retrieval=self.checked_retrieve(prompt, history, k, scope)
+        if check['result'] == 'incomplete':
+            answer={'answer':[{'type': 'paragraph', 'data': check['message']}]}
+            yield {'event':'done','answer':json.dumps(answer),'sources':[]}
+            return
+        yield {'event':'stage','data':'searching'}
+        phrases, sources=retrieval()
+        yield {'event':'stage','data':'answering'}
+        messages=self.answer_messages(prompt, history, sources)
+        parts=[]
+        for token in self.gpt.json_gpt_stream(messages, 15000):
+            parts.append(token)
+            yield {'event':'token','data':token}
+        answer, sources=self.finish_answer(''.join(parts), phrases, sources)
+        self.store_answer(key, prompt, answer, sources)
+        yield {'event':'done','answer':answer,'sources':sources}
+
 
 
     #-------------------------------------------------for multi-research--------------
 
     def open_file(self, file_id, filename, table, table_id):
-        file_path='../temp/'+table+'-'+table_id+'/'+file_id+'-'+filename
-        collect=Collector()
-        if filename.lower().endswith('.pdf'):
-            document=collect.pdf_raw(file_path)
-        elif filename.lower().endswith('.docx'):
-            document=collect.docx_styles(file_path)
-        elif filename.lower().endswith('.htm') or filename.lower().endswith('.html'):
-            document=collect.html_styles(file_path)
-        return document
-
-    # tool for retrieving from table and answer
-    def research(self, question, source):
-        #load the actual document
-        document=self.open_file(source['file_id'],source['filename'],source['table'],source['table_id'])
-        text = ''
-        for t in document:
-            text = text +'\n'+ t['text']
-        splitter = TokenTextSplitter(chunk_size=125000, chunk_overlap=200)
-        chunks=splitter.split_text(text)
-        answers=''
-        for chunk in chunks:
-            context = "Research topic (Question): " + question + "\n\n\n Document Name(Citation): "+source['citation']+ "\nDocument/ Part of Document: " + chunk
-            messages = [{"role": "system", "content": self.researcher}]
-            messages.append({"role": "user", "content": context})
-            answers= answers + '\n' +self.gpt.gpt_4o(messages, 15000)
-        return answers
+        return Documents.open(table, table_id, file_id, filename)
+
+    # tool for retrieving from table and answer, the research of every source (None when nothing of it could be read)
+    @Tracing.traced('rag.research')
+    def research(self, question, sources, query=None):
+        return self.reader.run(question, sources, query)
 
+    @Tracing.traced('rag.multi_step')
     def multi_step(self,prompt, history, k=3, scope=3):
         #first generate phrases
         phrases=self.phraser(prompt, history, str(self.euclid.tables()), scope)
         raw_sources=[]
-        for phrase in phrases:
-            raw_sources.extend(self.euclid.search(phrase['table'], phrase['phrase'], k))
+        for results in self.euclid.search_phrases(phrases, k, mode=self.search_mode):
+            raw_sources.extend(results)
 
         #unique
         sources=self.load_unique(raw_sources)
+        #research all sources at once, sources that fail or time out are left out
+        #passages are picked with the words of the phrases only, not the table names and keys of str(phrases)
+        answers=self.research(str(phrases), sources, ' '.join(phrase['phrase'] for phrase in phrases))
         researches=[]
-        for source in sources:
-            researches.append({'citation':source['citation'],'research_answer':self.research(str(phrases),source)})
+        for source, answer in zip(sources, answers):
+            if answer is not None:
+                researches.append({'citation':source['citation'],'research_answer':answer})
         #done with researches
         context = "Research: " + str(researches) + "\n Prompt:" + prompt
         messages = [{"role": "system", "content": self.system_multi}]
-        for message in history:
-            messages.append({"role": "user", "content": message['user']})
-            messages.append({"role": "assistant", "content": str(message['system'])})
+        messages.extend(self.history.messages(history, self.budgets['multi']))
         messages.append({"role": "user", "content": context})
         answ = self.gpt.json_gpt(messages, 16380)
         answer=json.loads(answ)
@@ -0,0 +1,58 @@
+"""
+    Class Research for reading the sources found for a question with the AI, used by RAG (multi_step) and Heads (drafting).
+    1. chunks: the parts of a source that are read, the passages of the document that match the query best (see
+       Documents.select, the query is the text of the search phrases) or, with full_document, the whole document split into
+       chunks of chunk_size tokens.
+    2. read: the research answer of the model for one chunk.
+    3. run: the research answer of every source, None for a source of which nothing could be read. Documents are opened on a
+       pool of the call and the model calls of all sources go through one pool shared by the whole process, so at most
+       workers research calls run at once however many requests are researching.
+
+    The settings are class attributes so RAG and Heads cannot drift apart.
+"""
+
+from documents import Documents
+from parallel import Parallel
+from langchain.text_splitter import TokenTextSplitter
+
+class Research:
+    #research calls running at once in the process and the seconds allowed for each
+    workers = 4
+    timeout = 300
+    #research reads only the passages of a source that match the question (within passage_budget tokens),
+    #full_document sends the whole document instead
+    full_document = False
+    passage_budget = 12000
+
+    def __init__(self, gpt, system, chunk_size, max_tokens):
+        self.gpt = gpt
+        self.system = system
+        self.chunk_size = chunk_size
+        self.max_tokens = max_tokens
+
+    def chunks(self, query, source):
+        document = Documents.open(source['table'], source['table_id'], source['file_id'], source['filename'])
+        if self.full_document:
+            text = '\n'.join(t['text'] for t in document)
+            splitter = TokenTextSplitter(chunk_size=self.chunk_size, chunk_overlap=200)
+            return splitter.split_text(text)
+        return [Documents.select(document, query, self.passage_budget)]
+
+    def read(self, question, source, chunk):
+        context = "Research topic (Question): " + question + "\n\n\n Document Name(Citation): " + source['citation'] + "\nDocument/ Part of Document: " + chunk
+        messages = [{"role": "system", "content": self.system}]
+        messages.append({"role": "user", "content": context})
+        return self.gpt.gpt_4o(messages, self.max_tokens)
+
+    # query picks the passages that are read, the question (given to the model) is used when there is none
+    def run(self, question, sources, query=None):
+        parts = Parallel.map(lambda source: self.chunks(query or question, source), sources, self.workers, self.timeout)
+        reads = [(i, chunk) for i, chunks in enumerate(parts) if chunks for chunk in chunks]
+        answers = Parallel.map(lambda read: self.read(question, sources[read[0]], read[1]), reads, self.workers,
+                               self.timeout, None, 'research')
+        researches = [None] * len(sources)
+        for (i, chunk), answer in zip(reads, answers):
+            #a failed chunk adds nothing
+            if answer is not None:
+                researches[i] = (researches[i] or '') + '\n' + answer
+        return researches
@@ -0,0 +1,120 @@
+"""
+    Class Scheduler for keeping calls to the OpenAI API within the account's rate limits.
+    Every model has a requests-per-minute and a tokens-per-minute token bucket. Callers take a ticket and are served in the
+    order they arrived once both buckets can cover their request. Requests that fail with 429 or 5xx are retried with jittered
+    exponential backoff, honouring the Retry-After header when the API sends one, and a 429 pauses every caller of that model.
+
+"""
+
+import time
+import random
+import threading
+import openai
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until n tokens are available
+    def wait_time(self, n):
+        n = min(n, self.capacity)
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    def take(self, n):
+        self.tokens -= min(n, self.capacity)
+
+
+class Scheduler:
+    def __init__(self, rpm, tpm, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+        self.paused_until = 0.0
+
+    # block until the buckets can cover a request of the given size, callers are served first come first served
+    def acquire(self, tokens):
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while True:
+                if ticket == self.serving:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    wait = max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        self.serving += 1
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+
+    # correct the token bucket once the real usage of a request is known
+    def settle(self, estimated, used):
+        with self.cond:
+            self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + estimated - used)
+            self.cond.notify_all()
+
+    def pause(self, seconds):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @staticmethod
+    def retry_after(e):
+        response = getattr(e, 'response', None)
+        if response is None:
+            return None
+        try:
+            if response.headers.get('retry-after-ms'):
+                return float(response.headers['retry-after-ms']) / 1000.0
+            if response.headers.get('retry-after'):
+                return float(response.headers['retry-after'])
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def retryable(e):
+        if isinstance(e, openai.RateLimitError):
+            #an exhausted quota will not recover by waiting
+            return getattr(e, 'code', None) != 'insufficient_quota'
+        if isinstance(e, openai.APIStatusError):
+            return e.status_code >= 500
+        return isinstance(e, (openai.APIConnectionError, openai.APITimeoutError))
+
+    # run a request under the limits, retrying on rate limits and server errors
+    def call(self, fn, tokens):
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not self.retryable(e):
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                after = self.retry_after(e)
+                if after is not None:
+                    delay = max(delay, after)
+                if isinstance(e, openai.RateLimitError):
+                    self.pause(delay)
+                print(f"OpenAI request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,181 @@
+"""
+    Checks of MatrixTable on a table in a temporary folder, for float32 and float16 tables.
+    1. upsert, query, get, delete and count, and a second instance and a reloaded instance seeing the same rows.
+    2. compaction once more than a quarter of the rows are deleted, and the log folded into a new snapshot once it is large.
+    3. a torn last log entry is dropped and truncated by the next write, a corrupt snapshot raises instead of starting empty.
+    4. several processes writing to the same table at once (the folder lock), and a process reading while another compacts.
+
+    Usage:
+        python test_matrix.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from matrix import MatrixTable
+
+DIM = 16
+
+def vectors(n, seed):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+def test_basic(path, dtype):
+    table = MatrixTable('basic', path, dtype)
+    other = MatrixTable('basic', path, dtype)
+    check(table.count() == 0, 'a new table is empty')
+    check(table.query(vectors(1, 0))['ids'] == [[]], 'an empty table returns no results')
+    embeddings = vectors(50, 1)
+    ids = ['id' + str(i) for i in range(50)]
+    metadatas = [{'file': i % 5, 'page': i} for i in range(50)]
+    table.upsert(ids, embeddings, ['text ' + str(i) for i in range(50)], metadatas)
+    check(table.count() == 50, 'upsert adds the rows')
+    result = table.query(embeddings[:3], n_results=4)
+    check([ids[0] for ids in result['ids']] == ['id0', 'id1', 'id2'], 'a vector is its own nearest neighbour')
+    check(abs(result['distances'][0][0]) < 1e-3, 'the distance to itself is 0')
+    check(result['documents'][1][0] == 'text 1' and result['metadatas'][2][0] == {'file': 2, 'page': 2}, 'rows are returned')
+    result = table.query(embeddings[:1], n_results=50, where={'file': 3})
+    check(sorted(result['ids'][0]) == sorted(ids[3::5]), 'where filters the results')
+    result = table.get(where={'$and': [{'file': {'$in': [1, 2]}}, {'page': {'$gte': 40}}]})
+    check(sorted(result['ids']) == ['id41', 'id42', 'id46', 'id47'], 'get filters with $and, $in and $gte')
+    #the other instance catches up with the log
+    check(other.count() == 50, 'another instance sees the rows')
+    other.upsert(['id0'], vectors(1, 2), ['changed'], [{'file': 0, 'page': 0}])
+    check(table.get(ids=['id0'])['documents'] == ['changed'], 'an upsert replaces the row')
+    check(table.query(vectors(1, 2), n_results=1)['ids'] == [['id0']], 'an upsert replaces the vector')
+    table.delete(ids=['id1', 'id2'])
+    table.delete(where={'file': 4})
+    check(other.count() == 38, 'deletes are seen by another instance')
+    check('id1' not in other.query(embeddings[1:2], n_results=50)['ids'][0], 'deleted rows are not returned')
+    reloaded = MatrixTable('basic', path, dtype)
+    check(reloaded.count() == 38, 'a reloaded table has the same rows')
+    check(reloaded.dtype == dtype and reloaded.matrix.dtype == np.float32, 'the dtype is kept, queries run on float32')
+    check(reloaded.query(embeddings[10:11], n_results=1)['ids'] == [['id10']], 'a reloaded table returns the same results')
+    check(reloaded.get(ids=['id7'], include=('embeddings',))['embeddings'][0] is not None, 'embeddings are returned')
+
+def test_compact(path, dtype):
+    table = MatrixTable('compact', path, dtype)
+    embeddings = vectors(2000, 3)
+    ids = ['id' + str(i) for i in range(2000)]
+    table.upsert(ids, embeddings, None, [{'even': i % 2 == 0} for i in range(2000)])
+    reader = MatrixTable('compact', path, dtype)
+    check(reader.count() == 2000, 'the reader sees the rows')
+    vectors_name = table.vectors_name
+    table.delete(where={'even': False})
+    check(table.vectors_name != vectors_name, 'deleting half of the rows compacts the table')
+    check(len(table.rows) == 1000 and table.count() == 1000, 'compaction drops the deleted rows')
+    check(not os.path.exists(path + 'compact/' + vectors_name), 'the old vectors file is removed')
+    result = reader.query(embeddings[::2][:20], n_results=1)
+    check([r[0] for r in result['ids']] == ids[::2][:20], 'another instance reads the compacted table')
+    table.upsert(['new'], vectors(1, 4))
+    check(reader.query(vectors(1, 4), n_results=1)['ids'] == [['new']], 'rows are added after a compaction')
+    check(MatrixTable('compact', path, dtype).count() == 1001, 'a compacted table reloads')
+
+def test_fold(path, dtype):
+    table = MatrixTable('fold', path, dtype)
+    table.upsert(['first'], vectors(1, 5), ['x'])
+    log_name = table.log_name
+    document = 'x' * 2000
+    for i in range(600):
+        table.upsert(['id' + str(i)], vectors(1, 100 + i), [document])
+    check(table.log_name != log_name, 'a large log is folded into a new snapshot')
+    check(os.path.getsize(path + 'fold/' + table.log_name) < 1 << 20, 'the new log starts empty')
+    check(not os.path.exists(path + 'fold/' + log_name), 'the old log is removed')
+    check(MatrixTable('fold', path, dtype).count() == 601, 'the folded table reloads')
+
+def test_torn(path, dtype):
+    table = MatrixTable('torn', path, dtype)
+    table.upsert(['a', 'b'], vectors(2, 6))
+    log = path + 'torn/' + table.log_name
+    size = os.path.getsize(log)
+    #a process that stopped in the middle of writing a log entry
+    with open(log, 'ab') as f:
+        f.write(b'\x80\x05\x95\x20\x00\x00')
+    reloaded = MatrixTable('torn', path, dtype)
+    check(reloaded.count() == 2, 'a torn log entry is ignored')
+    reloaded.upsert(['c'], vectors(1, 7))
+    check(os.path.getsize(log) > size and MatrixTable('torn', path, dtype).count() == 3, 'the next write drops the torn entry')
+    with open(path + 'torn/rows.pkl', 'wb') as f:
+        f.write(b'not a pickle')
+    try:
+        MatrixTable('torn', path, dtype)
+    except Exception as e:
+        check('could not be read' in str(e), 'a corrupt snapshot names the table')
+    else:
+        raise AssertionError('a corrupt snapshot raises')
+
+def write(path, dtype, worker):
+    table = MatrixTable('processes', path, dtype)
+    for batch in range(10):
+        start = worker * 1000 + batch * 20
+        ids = ['id' + str(i) for i in range(start, start + 20)]
+        table.upsert(ids, vectors(20, start), None, [{'worker': worker}] * 20)
+        if batch % 3 == 2:
+            table.delete(ids=ids[:5])
+
+def test_processes(path, dtype):
+    processes = [multiprocessing.Process(target=write, args=(path, dtype, worker)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        check(process.exitcode == 0, 'a writer failed')
+    table = MatrixTable('processes', path, dtype)
+    check(table.count() == 4 * (200 - 3 * 5), 'no write of another process is lost')
+    for worker in range(4):
+        start = worker * 1000 + 60
+        result = table.query(vectors(20, start)[5:], n_results=1)
+        check([r[0] for r in result['ids']] == ['id' + str(i) for i in range(start + 5, start + 20)], 'vectors are not mixed up')
+
+def read(path, dtype, stop, errors):
+    table = MatrixTable('reading', path, dtype)
+    kept = vectors(500, 8)
+    while not stop.is_set():
+        try:
+            result = table.query(kept[:10], n_results=1)
+            if [r[0] for r in result['ids']] != ['keep' + str(i) for i in range(10)]:
+                errors.put('wrong results ' + str(result['ids']))
+        except Exception as e:
+            errors.put(repr(e))
+
+def test_reading(path, dtype):
+    table = MatrixTable('reading', path, dtype)
+    table.upsert(['keep' + str(i) for i in range(500)], vectors(500, 8))
+    stop = multiprocessing.Event()
+    errors = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=read, args=(path, dtype, stop, errors))
+    reader.start()
+    for round in range(20):
+        ids = ['drop' + str(round) + '-' + str(i) for i in range(1000)]
+        table.upsert(ids, vectors(1000, 1000 + round))
+        table.delete(ids=ids)
+    stop.set()
+    reader.join()
+    check(reader.exitcode == 0, 'the reader failed')
+    check(errors.empty(), 'the reader saw a compaction: ' + ('' if errors.empty() else errors.get()))
+    check(len(os.listdir(path + 'reading/')) <= 5, 'old logs and vectors are cleaned up')
+
+def main():
+    tests = [test_basic, test_compact, test_fold, test_torn, test_processes, test_reading]
+    failed = 0
+    for dtype in ('float32', 'float16'):
+        for test in tests:
+            path = tempfile.mkdtemp() + '/'
+            try:
+                test(path, dtype)
+                print('ok', test.__name__, dtype)
+            except Exception as e:
+                failed = failed + 1
+                print('FAILED', test.__name__, dtype, repr(e))
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+    Checks of Scheduler without calling the API, the openai error classes it looks at are replaced by stand-ins.
+    1. retries: 5xx and 429 errors are retried up to max_retries, Retry-After is honoured, 4xx and an exhausted quota are not
+       retried.
+    2. limits: the requests-per-minute and tokens-per-minute buckets hold callers back once they are used up, and settle
+       returns the tokens a request did not use.
+    3. order: callers are served in the order they arrived, a small request does not pass a large one waiting for tokens.
+    4. pause: a 429 holds back every caller of the model, not only the one that got it.
+
+    Usage:
+        python test_scheduler.py
+"""
+
+import sys
+import time
+import types
+import threading
+
+#the parts of the openai package Scheduler uses, so the checks run without it and raise errors of a known shape
+openai = types.ModuleType('openai')
+class APIError(Exception):
+    pass
+class APIStatusError(APIError):
+    def __init__(self, status_code, headers=None, code=None):
+        super().__init__('status ' + str(status_code))
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(headers=headers or {})
+        self.code = code
+class RateLimitError(APIStatusError):
+    def __init__(self, headers=None, code=None):
+        super().__init__(429, headers, code)
+class APIConnectionError(APIError):
+    pass
+class APITimeoutError(APIConnectionError):
+    pass
+for error in (APIError, APIStatusError, RateLimitError, APIConnectionError, APITimeoutError):
+    setattr(openai, error.__name__, error)
+sys.modules['openai'] = openai
+
+from scheduler import Scheduler
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+# a request that fails with the given errors before it returns 'done'
+def failing(*errors):
+    calls = []
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'done'
+    return fn, calls
+
+def test_retry():
+    scheduler = Scheduler(6000, 1000000, max_retries=3, base_delay=0.01, max_delay=0.05)
+    fn, calls = failing(APIStatusError(500), APIConnectionError(), APITimeoutError())
+    check(scheduler.call(fn, 10) == 'done' and len(calls) == 4, 'server and connection errors are retried')
+    fn, calls = failing(*[APIStatusError(503)] * 4)
+    try:
+        scheduler.call(fn, 10)
+        raise AssertionError('errors after max_retries are raised')
+    except APIStatusError:
+        check(len(calls) == 4, 'a request is tried max_retries + 1 times')
+    for error in (APIStatusError(400), RateLimitError(code='insufficient_quota'), ValueError('bad')):
+        fn, calls = failing(error)
+        try:
+            scheduler.call(fn, 10)
+            raise AssertionError(repr(error) + ' is raised')
+        except type(error):
+            check(len(calls) == 1, repr(error) + ' is not retried')
+
+def test_retry_after():
+    scheduler = Scheduler(6000, 1000000, base_delay=0.001, max_delay=0.001)
+    fn, calls = failing(APIStatusError(502, {'retry-after-ms': '300'}), APIStatusError(502, {'retry-after': '0.2'}))
+    scheduler.call(fn, 10)
+    check(calls[1] - calls[0] >= 0.29 and calls[2] - calls[1] >= 0.19, 'Retry-After is waited for')
+    check(Scheduler.retry_after(APIStatusError(502, {'retry-after': 'soon'})) is None, 'a Retry-After date is ignored')
+
+def test_requests():
+    #10 requests a second once the burst of the bucket is used up
+    scheduler = Scheduler(600, 1000000)
+    scheduler.requests.tokens = 0
+    start = time.monotonic()
+    for i in range(5):
+        scheduler.acquire(1)
+    elapsed = time.monotonic() - start
+    check(0.45 <= elapsed < 0.8, 'requests are held to the requests per minute, took ' + str(elapsed))
+
+def test_tokens():
+    #100 tokens a second
+    scheduler = Scheduler(6000, 6000)
+    scheduler.tokens.tokens = 0
+    start = time.monotonic()
+    scheduler.acquire(30)
+    scheduler.acquire(20)
+    elapsed = time.monotonic() - start
+    check(0.45 <= elapsed < 0.8, 'requests are held to the tokens per minute, took ' + str(elapsed))
+    scheduler.settle(50, 10)
+    check(scheduler.tokens.tokens >= 40, 'settle returns the tokens that were not used')
+    #a request larger than the bucket waits for a full bucket instead of forever
+    scheduler = Scheduler(6000, 60)
+    scheduler.acquire(1000)
+    check(scheduler.tokens.tokens == 0, 'a request larger than the bucket takes the whole bucket')
+
+def test_order():
+    scheduler = Scheduler(6000, 6000)
+    scheduler.tokens.tokens = 0
+    served = []
+    def take(name, tokens):
+        scheduler.acquire(tokens)
+        served.append(name)
+    large = threading.Thread(target=take, args=('large', 50))
+    large.start()
+    #the large request holds the first ticket before the small ones arrive
+    while scheduler.next_ticket == 0:
+        time.sleep(0.001)
+    small = [threading.Thread(target=take, args=('small' + str(i), 1)) for i in range(3)]
+    for thread in small:
+        thread.start()
+        while scheduler.next_ticket < small.index(thread) + 2:
+            time.sleep(0.001)
+    for thread in [large] + small:
+        thread.join()
+    check(served == ['large', 'small0', 'small1', 'small2'], 'callers are served first come first served: ' + str(served))
+
+def test_pause():
+    scheduler = Scheduler(6000, 1000000, base_delay=0.001, max_delay=0.001)
+    fn, calls = failing(RateLimitError({'retry-after': '0.4'}))
+    thread = threading.Thread(target=scheduler.call, args=(fn, 10))
+    thread.start()
+    while not calls:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    start = time.monotonic()
+    scheduler.acquire(1)
+    waited = time.monotonic() - start
+    thread.join()
+    check(waited >= 0.3, 'a 429 pauses the other callers, waited ' + str(waited))
+    check(len(calls) == 2, 'the rate limited request is retried')
+    fn, calls = failing(APIStatusError(500, {'retry-after': '0.3'}))
+    thread = threading.Thread(target=scheduler.call, args=(fn, 10))
+    thread.start()
+    while not calls:
+        time.sleep(0.001)
+    start = time.monotonic()
+    scheduler.acquire(1)
+    waited = time.monotonic() - start
+    thread.join()
+    check(waited < 0.1, 'a server error does not pause the other callers, waited ' + str(waited))
+
+def main():
+    tests = [test_retry, test_retry_after, test_requests, test_tokens, test_order, test_pause]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print('ok', test.__name__)
+        except Exception as e:
+            failed = failed + 1
+            print('FAILED', test.__name__, repr(e))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+    Class Tracing for recording where the time and tokens of a request go.
+    1. span: a context manager timing a stage (a GPT call, a Euclid or Database operation, a RAG step). The wall time goes into
+       a histogram per stage and the span is added to the timings of the current request together with any token counts.
+    2. traced_class: a class decorator that puts every public method of a class in a span named prefix.method.
+    3. start and timings: set the id of the current request and read back the spans recorded for it.
+    4. metrics: histograms, counters and gauges in the Prometheus text format for the /metrics endpoint.
+
+    The current request is kept in a context variable, use propagate to carry it into worker threads.
+"""
+
+import time
+import uuid
+import inspect
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float('inf'))
+
+current_request = contextvars.ContextVar('current_request', default=None)
+current_spans = contextvars.ContextVar('current_spans', default=None)
+
+class Tracing:
+    lock = threading.Lock()
+    histograms = {}
+    counters = {}
+    gauges = {}
+
+    # begin tracing a new request
+    @staticmethod
+    def start(rid=None):
+        rid = rid or uuid.uuid4().hex
+        current_request.set(rid)
+        current_spans.set([])
+        return rid
+
+    @staticmethod
+    def request_id():
+        return current_request.get()
+
+    @staticmethod
+    def timings():
+        return list(current_spans.get() or [])
+
+    @staticmethod
+    def observe(stage, seconds):
+        with Tracing.lock:
+            histogram = Tracing.histograms.get(stage)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+                Tracing.histograms[stage] = histogram
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @staticmethod
+    def count(name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with Tracing.lock:
+            Tracing.counters[key] = Tracing.counters.get(key, 0) + n
+
+    @staticmethod
+    def gauge(name, value, **labels):
+        with Tracing.lock:
+            Tracing.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    # time a stage, the yielded dict can be filled with prompt_tokens and completion_tokens
+    @staticmethod
+    @contextmanager
+    def span(stage, **attrs):
+        record = dict(attrs)
+        start = time.perf_counter()
+        error = None
+        try:
+            yield record
+        except Exception as e:
+            error = e.__class__.__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            Tracing.observe(stage, seconds)
+            for kind in ('prompt_tokens', 'completion_tokens'):
+                if record.get(kind):
+                    Tracing.count('tokens_total', record[kind], stage=stage, kind=kind.split('_')[0])
+            if error:
+                Tracing.count('errors_total', stage=stage, error=error)
+            spans = current_spans.get()
+            if spans is not None:
+                record.update({'stage': stage, 'ms': round(seconds * 1000, 2), 'request_id': current_request.get()})
+                if error:
+                    record['error'] = error
+                spans.append(record)
+
+    # decorator timing every call of a function
+    @staticmethod
+    def traced(stage):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with Tracing.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # class decorator timing every public method, generators are left alone as their work happens after the call
+    @staticmethod
+    def traced_class(prefix):
+        def decorator(cls):
+            for name, value in list(vars(cls).items()):
+                if name.startswith('_') or not callable(value) or isinstance(value, (staticmethod, classmethod)) or inspect.isgeneratorfunction(value):
+                    continue
+                setattr(cls, name, Tracing.traced(prefix + '.' + name)(value))
+            return cls
+        return decorator
+
+    # run a function in another thread with the request context of the caller
+    @staticmethod
+    def propagate(func):
+        context = contextvars.copy_context()
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return context.copy().run(func, *args, **kwargs)
+        return wrapper
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(k + '="' + str(v).replace('"', '\\"') + '"' for k, v in labels) + '}'
+
+    # everything recorded so far in the Prometheus text format
+    @staticmethod
+    def metrics():
+        lines = ['# TYPE stage_seconds histogram']
+        with Tracing.lock:
+            for stage, histogram in sorted(Tracing.histograms.items()):
+                for bound, n in zip(BUCKETS, histogram['buckets']):
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append('stage_seconds_bucket{stage="' + stage + '",le="' + le + '"} ' + str(n))
+                lines.append('stage_seconds_sum{stage="' + stage + '"} ' + str(round(histogram['sum'], 6)))
+                lines.append('stage_seconds_count{stage="' + stage + '"} ' + str(histogram['count']))
+            names = []
+            for (name, labels), value in sorted(Tracing.counters.items()):
+                if name not in names:
+                    names.append(name)
+                    lines.append('# TYPE ' + name + ' counter')
+                lines.append(name + Tracing._labels(labels) + ' ' + str(value))
+            for (name, labels), value in sorted(Tracing.gauges.items()):
+                if name not in names:
+                    names.append(name)
+                    lines.append('# TYPE ' + name + ' gauge')
+                lines.append(name + Tracing._labels(labels) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'